@@ -22,8 +22,16 @@ It also:
 testedwith = '2.7 2.7.1 2.7.2 2.8 2.8.1 2.8.2 2.9 2.9.1 2.9.2 3.0'
 buglink = 'https://bitbucket.org/marmoute/mutable-history/issues'
 
+import os
 import sys
+import time
 import random
+import shutil
+import tempfile
+import weakref
+import heapq
+import struct
+from array import array
 
 import mercurial
 from mercurial import util
@@ -44,17 +52,23 @@ from mercurial import bookmarks
 from mercurial import cmdutil
 from mercurial import commands
 from mercurial import context
+from mercurial import dispatch
 from mercurial import copies
 from mercurial import error
 from mercurial import extensions
+from mercurial import filemerge
 from mercurial import hg
+from mercurial import localrepo
 from mercurial import lock as lockmod
 from mercurial import merge
 from mercurial import node
 from mercurial import phases
 from mercurial import revset
 from mercurial import scmutil
+from mercurial import simplemerge
+from mercurial import templatefilters
 from mercurial import templatekw
+from mercurial import worker
 from mercurial.i18n import _
 from mercurial.commands import walkopts, commitopts, commitopts2
 from mercurial.node import nullid
@@ -81,6 +95,15 @@ class exthelper(object):
     methods are then used as decorator for various purpose.
 
     All decorators return the original function and may be chained.
+
+    Registrations are frozen the first time a setup method runs: the table
+    is built once per process. Setup methods may be called again, by a
+    command server reloading a repository for example, without installing
+    anything twice. `installed` counts what was actually installed.
+
+    Wrappers of core commands are installed the first time the command is
+    looked up in the command table, when it is run or aliased for example.
+    Other commands do not pay for them.
     """
 
     def __init__(self):
@@ -93,6 +116,40 @@ class exthelper(object):
         self._extcommandwrappers = []
         self._functionwrappers = []
         self._duckpunchers = []
+        self._frozen = False
+        self._setupdone = set()
+        # command -> wrappers not installed yet
+        self._pendingcommandwrappers = {}
+        self._setuprepos = weakref.WeakKeyDictionary()
+        self.installed = dict.fromkeys(['attributes', 'commandwrappers',
+                                        'extcommandwrappers',
+                                        'functionwrappers', 'revsets',
+                                        'templatekws', 'repos'], 0)
+
+    def _freeze(self):
+        """turn registrations into an immutable table"""
+        if self._frozen:
+            return
+        for attr in ('_uicallables', '_extcallables', '_repocallables',
+                     '_revsetsymbols', '_templatekws', '_commandwrappers',
+                     '_extcommandwrappers', '_functionwrappers',
+                     '_duckpunchers'):
+            setattr(self, attr, tuple(getattr(self, attr)))
+        self._frozen = True
+
+    def _register(self, attr, item):
+        if self._frozen:
+            raise util.Abort('cannot register %r after extension setup'
+                             % (item,))
+        getattr(self, attr).append(item)
+
+    def _firstsetup(self, phase):
+        """freeze the table, return False if <phase> already ran"""
+        self._freeze()
+        if phase in self._setupdone:
+            return False
+        self._setupdone.add(phase)
+        return True
 
     def final_uisetup(self, ui):
         """Method to be used as the extension uisetup
@@ -113,15 +170,43 @@ class exthelper(object):
         - Setup of pre-* and post-* hooks
         - pushkey setup
         """
+        if not self._firstsetup('ui'):
+            return
         for cont, funcname, func in self._duckpunchers:
             setattr(cont, funcname, func)
+            self.installed['attributes'] += 1
+        pending = self._pendingcommandwrappers
         for command, wrapper in self._commandwrappers:
-            extensions.wrapcommand(commands.table, command, wrapper)
+            pending.setdefault(command, []).append(wrapper)
+        if pending:
+            extensions.wrapfunction(cmdutil, 'findcmd', self._findcmd)
         for cont, funcname, wrapper in self._functionwrappers:
             extensions.wrapfunction(cont, funcname, wrapper)
+            self.installed['functionwrappers'] += 1
         for c in self._uicallables:
             c(ui)
 
+    def _findcmd(self, orig, cmd, table, *args, **kwargs):
+        """install pending wrappers of a core command found in the table
+
+        Dispatch, aliases and `extensions.wrapcommand` all look commands up
+        with `cmdutil.findcmd`: wrappers are in place before the command
+        function is picked, and other extensions wrap on top of them.
+        """
+        found = orig(cmd, table, *args, **kwargs)
+        pending = self._pendingcommandwrappers
+        if pending and table is commands.table:
+            aliases = found[0]
+            wrappers = []
+            for alias in aliases:
+                wrappers.extend(pending.pop(alias, ()))
+            if wrappers:
+                for wrapper in wrappers:
+                    extensions.wrapcommand(table, aliases[0], wrapper)
+                    self.installed['commandwrappers'] += 1
+                found = orig(cmd, table, *args, **kwargs)
+        return found
+
     def final_extsetup(self, ui):
         """Method to be used as a the extension extsetup
 
@@ -132,18 +217,26 @@ class exthelper(object):
         - Add a global option to all commands
         - Register revset functions
         """
+        if not self._firstsetup('ext'):
+            return
         knownexts = {}
         for name, symbol in self._revsetsymbols:
             revset.symbols[name] = symbol
+            self.installed['revsets'] += 1
         for name, kw in self._templatekws:
             templatekw.keywords[name] = kw
+            self.installed['templatekws'] += 1
         for ext, command, wrapper in self._extcommandwrappers:
             if ext not in knownexts:
-                e = extensions.find(ext)
+                try:
+                    e = extensions.find(ext)
+                except KeyError:
+                    e = None
                 if e is None:
                     raise util.Abort('extension %s not found' % ext)
                 knownexts[ext] = e.cmdtable
-            extensions.wrapcommand(knownexts[ext], commands, wrapper)
+            extensions.wrapcommand(knownexts[ext], command, wrapper)
+            self.installed['extcommandwrappers'] += 1
         for c in self._extcallables:
             c(ui)
 
@@ -155,7 +248,14 @@ class exthelper(object):
         - All hooks but pre-* and post-*
         - Modify configuration variables
         - Changes to repo.__class__, repo.dirstate.__class__
+
+        A repository already set up is left untouched.
         """
+        self._freeze()
+        if repo in self._setuprepos:
+            return
+        self._setuprepos[repo] = True
+        self.installed['repos'] += 1
         for c in self._repocallables:
             c(ui, repo)
 
@@ -168,7 +268,7 @@ class exthelper(object):
             def setupbabar(ui):
                 print 'this is uisetup!'
         """
-        self._uicallables.append(call)
+        self._register('_uicallables', call)
         return call
 
     def extsetup(self, call):
@@ -180,7 +280,7 @@ class exthelper(object):
             def setupcelestine(ui):
                 print 'this is extsetup!'
         """
-        self._extcallables.append(call)
+        self._register('_extcallables', call)
         return call
 
     def reposetup(self, call):
@@ -192,7 +292,7 @@ class exthelper(object):
             def setupzephir(ui, repo):
                 print 'this is reposetup!'
         """
-        self._repocallables.append(call)
+        self._register('_repocallables', call)
         return call
 
     def revset(self, symbolname):
@@ -209,7 +309,7 @@ class exthelper(object):
                 return [r for r in subset if 'babar' in repo[r].description()]
         """
         def dec(symbol):
-            self._revsetsymbols.append((symbolname, symbol))
+            self._register('_revsetsymbols', (symbolname, symbol))
             return symbol
         return dec
 
@@ -227,7 +327,7 @@ class exthelper(object):
                 return 'babar'
         """
         def dec(keyword):
-            self._templatekws.append((keywordname, keyword))
+            self._register('_templatekws', (keywordname, keyword))
             return keyword
         return dec
 
@@ -235,7 +335,8 @@ class exthelper(object):
         """Decorated function is a command wrapper
 
         The name of the command must be given as the decorator argument.
-        The wrapping is installed during `uisetup`.
+        The wrapping is installed the first time the command is looked up
+        after `uisetup`.
 
         If the second option `extension` argument is provided, the wrapping
         will be applied in the extension commandtable. This argument must be a
@@ -253,9 +354,10 @@ class exthelper(object):
         """
         def dec(wrapper):
             if extension is None:
-                self._commandwrappers.append((command, wrapper))
+                self._register('_commandwrappers', (command, wrapper))
             else:
-                self._extcommandwrappers.append((extension, command, wrapper))
+                self._register('_extcommandwrappers',
+                               (extension, command, wrapper))
             return wrapper
         return dec
 
@@ -274,7 +376,7 @@ class exthelper(object):
                 return orig(*args, **kwargs)
         """
         def dec(wrapper):
-            self._functionwrappers.append((container, funcname, wrapper))
+            self._register('_functionwrappers', (container, funcname, wrapper))
             return wrapper
         return dec
 
@@ -291,7 +393,7 @@ class exthelper(object):
                 return 'babar' in ctx.description
         """
         def dec(func):
-            self._duckpunchers.append((container, funcname, func))
+            self._register('_duckpunchers', (container, funcname, func))
             return func
         return dec
 
@@ -300,6 +402,99 @@ uisetup = eh.final_uisetup
 extsetup = eh.final_extsetup
 reposetup = eh.final_reposetup
 
+#####################################################################
+### Profiling                                                     ###
+#####################################################################
+
+# Opt-in instrumentation of the work done by evolve during a command:
+#
+#   [evolve]
+#   profile = True
+#   # append a JSON line per command to a file instead of printing
+#   profile.json = /path/to/file
+
+class profiler(object):
+    """Timers and counters of evolve work during a command"""
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        # name -> [calls, seconds]
+        self.timers = {}
+        # name -> count
+        self.counters = {}
+
+    def record(self, name, seconds):
+        timer = self.timers.setdefault(name, [0, 0.0])
+        timer[0] += 1
+        timer[1] += seconds
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self, ui, cmd):
+        path = ui.config('evolve', 'profile.json')
+        if path:
+            timers = dict((name, {'calls': calls, 'seconds': seconds})
+                          for name, (calls, seconds) in self.timers.iteritems())
+            data = {'command': cmd, 'timers': timers,
+                    'counters': self.counters}
+            try:
+                f = open(path, 'a')
+                try:
+                    f.write(templatefilters.json(data) + '\n')
+                finally:
+                    f.close()
+            except IOError, inst:
+                ui.warn(_('cannot write evolve profile to %s: %s\n')
+                        % (path, inst.strerror))
+            return
+        ui.write_err(_('evolve profile for %s:\n') % cmd)
+        for name, (calls, seconds) in sorted(self.timers.iteritems()):
+            ui.write_err('  %-24s %6i calls %10.6f seconds\n'
+                         % (name, calls, seconds))
+        for name, value in sorted(self.counters.iteritems()):
+            ui.write_err('  %-24s %6i\n' % (name, value))
+
+_profiler = profiler()
+
+def _profiled(name):
+    """Decorator recording calls and wall time of a function when the
+    profiler is enabled"""
+    def dec(func):
+        def profiled(*args, **kwargs):
+            if not _profiler.enabled:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _profiler.record(name, time.time() - start)
+        profiled.__name__ = func.__name__
+        profiled.__doc__ = func.__doc__
+        return profiled
+    return dec
+
+@eh.uisetup
+def _setupprofiler(ui):
+    if not ui.configbool('evolve', 'profile', False):
+        return
+    _profiler.enabled = True
+    def runcommand(orig, lui, repo, cmd, *args, **kwargs):
+        _profiler.reset()
+        try:
+            return orig(lui, repo, cmd, *args, **kwargs)
+        finally:
+            _profiler.report(lui, cmd)
+    extensions.wrapfunction(dispatch, 'runcommand', runcommand)
+    def changectxinit(orig, ctx, *args, **kwargs):
+        _profiler.count('changectx')
+        return orig(ctx, *args, **kwargs)
+    extensions.wrapfunction(context.changectx, '__init__', changectxinit)
+
 #####################################################################
 ### Critical fix                                                  ###
 #####################################################################
@@ -310,20 +505,1066 @@ def safereadmarkers(orig, data):
 
     Nullid successors was created by older version of evolve.
     """
-    nb = 0
-    for marker in orig(data):
-        if nullid in marker[1]:
-            marker = (marker[0],
-                      tuple(s for s in marker[1] if s != nullid),
-                      marker[2],
-                      marker[3])
-            nb += 1
-        yield marker
-    if nb:
-        e = sys.stderr
-        print >> e, 'repo contains %i invalid obsolescence markers' % nb
-
-getrevs = obsolete.getrevs
+    return markerreader(data)
+
+class markerreader(object):
+    """Markers encoded in the content of an obsstore
+
+    The data are decoded in place, nullid successors being dropped on the
+    way. Iterating yields marker tuples while `compactmarkers.load` keeps
+    the metadata as offsets into the data.
+
+    Data up to <validated> are known to only hold nullid successors in the
+    markers starting at the offsets in <repaired>, other markers there are
+    not checked.
+    """
+
+    def __init__(self, data, validated=0, repaired=()):
+        self.data = data
+        self.validated = validated
+        self.repaired = set(repaired)
+
+    def __iter__(self):
+        data = self.data
+        for pre, sucs, flags, mdstart, mdend in self.decode():
+            yield (pre, sucs, flags, data[mdstart:mdend])
+
+    def decode(self):
+        """Yield (precursor, successors, flags, metadata start, metadata
+        end) for every marker"""
+        data = self.data
+        validated, repaired = self.validated, self.repaired
+        off = 0
+        diskversion = struct.unpack_from('>B', data, off)[0]
+        off += 1
+        if diskversion != obsolete._fmversion:
+            raise util.Abort(_('parsing obsolete marker: unknown version %r')
+                             % diskversion)
+        fixed = struct.Struct(obsolete._fmfixed)
+        l = len(data)
+        nb = decoded = 0
+        while off + fixed.size <= l:
+            start = off
+            nbsuc, mdsize, flags, pre = fixed.unpack_from(data, off)
+            off += fixed.size
+            sucs = ()
+            if nbsuc:
+                end = off + 20 * nbsuc
+                sucs = tuple(data[o:o + 20] for o in xrange(off, end, 20))
+                off = end
+                if ((start >= validated or start in repaired)
+                    and nullid in sucs):
+                    sucs = tuple(s for s in sucs if s != nullid)
+                    if start not in repaired:
+                        repaired.add(start)
+                        nb += 1
+            if off + mdsize > l:
+                raise util.Abort(_('parsing obsolete marker: metadata is too '
+                                   'short, %d bytes expected, got %d')
+                                 % (mdsize, l - off))
+            yield pre, sucs, flags, off, off + mdsize
+            off += mdsize
+            decoded += 1
+        _profiler.count('markers.decoded', decoded)
+        if nb:
+            e = sys.stderr
+            print >> e, ('repo contains %i invalid obsolescence markers'
+                         % len(repaired))
+
+class markerrepair(object):
+    """Record of the nullid successors repaired in an obsstore
+
+    Stored in `.hg/cache/evolve-obsrepair`: the size of the data already
+    checked, a digest of its end and the offsets of the markers which had
+    nullid successors. The data checked are identified by their size and
+    last bytes, the obsstore only being appended to or rewritten.
+    """
+
+    _filename = 'cache/evolve-obsrepair'
+    # checked size, digest of the last checked bytes, repaired markers
+    _header = '>I20sI'
+    _tail = 4096
+
+    @classmethod
+    def _digest(cls, data, size):
+        return util.sha1(data[max(0, size - cls._tail):size]).digest()
+
+    @classmethod
+    def read(cls, opener, data):
+        """Return the (validated, repaired) arguments of a `markerreader`
+        for <data>"""
+        try:
+            raw = opener.read(cls._filename)
+            hsize = struct.calcsize(cls._header)
+            size, digest, nb = struct.unpack(cls._header, raw[:hsize])
+            repaired = _unpackints(raw[hsize:hsize + 4 * nb])
+        except (IOError, OSError, struct.error, ValueError):
+            return 0, ()
+        if (len(repaired) != nb or size > len(data)
+            or cls._digest(data, size) != digest):
+            return 0, ()
+        return size, repaired
+
+    @classmethod
+    def write(cls, opener, reader):
+        """Record that the data of <reader> have been checked"""
+        data = reader.data
+        repaired = array('i', sorted(reader.repaired))
+        try:
+            f = opener(cls._filename, 'w', atomictemp=True)
+            f.write(struct.pack(cls._header, len(data),
+                                cls._digest(data, len(data)), len(repaired)))
+            f.write(_packints(repaired))
+            f.close()
+        except (IOError, OSError, util.Abort):
+            # Abort may be raise by read only opener
+            pass
+
+def getrevs(repo, name):
+    # looked up at call time to go through the wrapper of `_getrevs`
+    return obsolete.getrevs(repo, name)
+
+#####################################################################
+### Compact marker storage                                        ###
+#####################################################################
+
+# The obsstore keeps every marker as a tuple, referenced from its `_all` list
+# and from the `precursors` and `successors` mappings. Those are replaced by
+# parallel arrays of integers, marker tuples being built only when accessed.
+
+class compactmarkers(object):
+    """Array backed list of obsolescence markers
+
+    Nodes are stored once in a node table and markers as parallel arrays of
+    node identifiers. Metadata stay encoded in a single buffer. Markers
+    sharing a precursor (or a successor) are chained through arrays, which
+    back the `successors` and `precursors` mappings.
+    """
+
+    def __init__(self):
+        # identifier <-> node
+        self.nodes = []
+        self.ids = {}
+        # per marker: precursor, flags, first successor slot, metadata
+        # bounds and previous marker with the same precursor
+        self._prec = array('i')
+        self._flags = array('B')
+        self._succstart = array('i', [0])
+        self._metastart = array('i')
+        self._metaend = array('i')
+        self._nextbyprec = array('i')
+        # metadata live in the data markers were loaded from, then in a
+        # buffer for markers appended afterward
+        self._loaded = ''
+        self._metadata = bytearray()
+        # per successor slot: successor, marker and previous slot with the
+        # same successor
+        self._succs = array('i')
+        self._slotmarker = array('i')
+        self._nextbysucc = array('i')
+        # per node: last marker (or slot) it is the precursor (successor) of
+        self._precheads = array('i')
+        self._succheads = array('i')
+        self.successors = markerrelation(self, True)
+        self.precursors = markerrelation(self, False)
+
+    def __len__(self):
+        return len(self._prec)
+
+    def __iter__(self):
+        return self.iterfrom(0)
+
+    def iterfrom(self, start):
+        """Iterate over markers from the <start>th one, building one tuple
+        at a time"""
+        for i in xrange(start, len(self._prec)):
+            yield self.marker(i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.marker(i)
+                    for i in xrange(*index.indices(len(self._prec)))]
+        if index < 0:
+            index += len(self._prec)
+        if not 0 <= index < len(self._prec):
+            raise IndexError(index)
+        return self.marker(index)
+
+    def __contains__(self, marker):
+        """Only markers sharing the precursor of <marker> are decoded"""
+        for i in self.successors.indexes(marker[0]):
+            if self.marker(i) == marker:
+                return True
+        return False
+
+    def marker(self, i):
+        """Build the tuple of the <i>th marker"""
+        nodes, succs = self.nodes, self._succs
+        sucs = tuple(nodes[succs[s]]
+                     for s in xrange(self._succstart[i],
+                                     self._succstart[i + 1]))
+        start, end = self._metastart[i], self._metaend[i]
+        loaded = len(self._loaded)
+        if end <= loaded:
+            metadata = self._loaded[start:end]
+        else:
+            metadata = str(self._metadata[start - loaded:end - loaded])
+        return (nodes[self._prec[i]], sucs, self._flags[i], metadata)
+
+    def _nodeid(self, n):
+        nid = self.ids.get(n)
+        if nid is None:
+            nid = len(self.nodes)
+            self.nodes.append(n)
+            self.ids[n] = nid
+            self._precheads.append(-1)
+            self._succheads.append(-1)
+        return nid
+
+    def _add(self, pre, sucs, flags, mdstart, mdend):
+        i = len(self._prec)
+        self.successors.invalidate(pre)
+        self.precursors.invalidate(*sucs)
+        pid = self._nodeid(pre)
+        self._prec.append(pid)
+        self._flags.append(flags)
+        self._nextbyprec.append(self._precheads[pid])
+        self._precheads[pid] = i
+        for suc in sucs:
+            sid = self._nodeid(suc)
+            slot = len(self._succs)
+            self._succs.append(sid)
+            self._slotmarker.append(i)
+            self._nextbysucc.append(self._succheads[sid])
+            self._succheads[sid] = slot
+        self._succstart.append(len(self._succs))
+        self._metastart.append(mdstart)
+        self._metaend.append(mdend)
+
+    def append(self, marker):
+        pre, sucs, flags, metadata = marker
+        start = len(self._loaded) + len(self._metadata)
+        self._metadata.extend(metadata)
+        self._add(pre, sucs, flags, start, start + len(metadata))
+
+    def extend(self, markers):
+        if isinstance(markers, markerreader) and not self._prec:
+            self.load(markers)
+        else:
+            for marker in markers:
+                self.append(marker)
+
+    def load(self, reader):
+        """Load the markers of a `markerreader` into an empty store"""
+        assert not self._prec
+        for pre, sucs, flags, mdstart, mdend in reader.decode():
+            self._add(pre, sucs, flags, mdstart, mdend)
+        self._loaded = reader.data
+
+class markerrelation(object):
+    """Read only {node: set(markers)} view of a `compactmarkers`
+
+    Markers are keyed by precursor for `successors` and by successor for
+    `precursors`, like the obsstore attributes of the same names. Sets are
+    kept once built, up to `_cachesize` of them, and shared between calls
+    like the sets of a plain mapping."""
+
+    _cachesize = 10000
+
+    def __init__(self, store, byprecursor):
+        self._store = store
+        self._byprecursor = byprecursor
+        self._cache = {}
+
+    def invalidate(self, *nodes):
+        """Forget the sets of <nodes>, new markers relating to them"""
+        cache = self._cache
+        if cache:
+            for n in nodes:
+                cache.pop(n, None)
+
+    def _heads(self):
+        if self._byprecursor:
+            return self._store._precheads
+        return self._store._succheads
+
+    def indexes(self, n):
+        """Return the indexes of the markers related to node <n>"""
+        store = self._store
+        nid = store.ids.get(n)
+        if nid is None:
+            return []
+        indexes = []
+        if self._byprecursor:
+            i = store._precheads[nid]
+            while i >= 0:
+                indexes.append(i)
+                i = store._nextbyprec[i]
+        else:
+            slot = store._succheads[nid]
+            while slot >= 0:
+                indexes.append(store._slotmarker[slot])
+                slot = store._nextbysucc[slot]
+        return indexes
+
+    def get(self, n, default=None):
+        markers = self._cache.get(n)
+        if markers is not None:
+            return markers
+        indexes = self.indexes(n)
+        if not indexes:
+            return default
+        markers = set(self._store.marker(i) for i in indexes)
+        if len(self._cache) >= self._cachesize:
+            self._cache.clear()
+        self._cache[n] = markers
+        return markers
+
+    def __getitem__(self, n):
+        markers = self.get(n)
+        if markers is None:
+            raise KeyError(n)
+        return markers
+
+    def __contains__(self, n):
+        nid = self._store.ids.get(n)
+        return nid is not None and self._heads()[nid] >= 0
+
+    def __iter__(self):
+        nodes = self._store.nodes
+        for nid, head in enumerate(self._heads()):
+            if head >= 0:
+                yield nodes[nid]
+
+    def __len__(self):
+        return sum(1 for head in self._heads() if head >= 0)
+
+    def keys(self):
+        return list(self)
+
+# repositories whose obsstore is being read, see `_repoobsstore`
+_loadingrepos = []
+
+@eh.wrapfunction(localrepo.localrepository.__dict__['obsstore'], 'func')
+def _repoobsstore(orig, repo):
+    """Make <repo> known to `_obsstoreload` while its obsstore is read
+
+    The repair record of the markers lives in the cache directory of the
+    repository, out of reach of the store opener used by the obsstore.
+    """
+    _loadingrepos.append(repo)
+    try:
+        return orig(repo)
+    finally:
+        _loadingrepos.pop()
+
+@eh.wrapfunction(obsolete.obsstore, '_load')
+def _obsstoreload(orig, store, markers):
+    """Store markers in a `compactmarkers` instead of tuples"""
+    if isinstance(store._all, knownmarkers):
+        store._all = store._all.markers
+    if not isinstance(store._all, compactmarkers):
+        compact = compactmarkers()
+        compact.extend(store._all)
+        store._all = compact
+        store.successors = compact.successors
+        store.precursors = compact.precursors
+    if (isinstance(markers, markerreader) and not store._all
+        and _loadingrepos):
+        # content of the obsstore file of a repository
+        repo = _loadingrepos[-1]
+        validated, repaired = markerrepair.read(repo.opener, markers.data)
+        markers.validated, markers.repaired = validated, set(repaired)
+        store._all.extend(markers)
+        if markers.validated < len(markers.data):
+            markerrepair.write(repo.opener, markers)
+    else:
+        store._all.extend(markers)
+    if nullid in store.precursors:
+        raise util.Abort(_('bad obsolescence marker detected: '
+                           'invalid successors nullid'))
+
+#####################################################################
+### Obsolescence cache                                            ###
+#####################################################################
+
+# This section contains caches built on top of the obsstore content
+#
+# - helpers to run code when a transaction is closed
+# - an integer based index of the obsolescence graph
+# - a cache of troubled revisions
+# - obsolescence sets kept between commands of a command server
+
+def _currenttransaction(repo):
+    """Return the transaction running on repo, None if there is none"""
+    tr = repo._transref and repo._transref() or None
+    if tr is not None and tr.running():
+        return tr
+    return None
+
+def _ontransactionclose(tr, key, callback):
+    """Register a callback to be called when transaction <tr> is closed
+
+    Callbacks are called in registration order, before the core `onclose`
+    logic. Registering a second callback for the same key is a no-op.
+
+    Transactions of Mercurial older than 3.0 have no `onclose`: callbacks
+    are then called when the outermost `close` starts.
+    """
+    callbacks = getattr(tr, '_evolvecallbacks', None)
+    if callbacks is None:
+        callbacks = tr._evolvecallbacks = ([], {})
+        def runcallbacks():
+            order, bykey = callbacks
+            while order:
+                bykey.pop(order.pop(0))()
+        if util.safehasattr(tr, 'onclose'):
+            origonclose = tr.onclose
+            def onclose():
+                runcallbacks()
+                if origonclose is not None:
+                    origonclose()
+            tr.onclose = onclose
+        else:
+            # a bound method would keep the transaction alive and prevent
+            # its __del__ from aborting it
+            trref = weakref.ref(tr)
+            def close():
+                t = trref()
+                if t.count == 1:
+                    runcallbacks()
+                return t.__class__.close(t)
+            tr.close = close
+    order, bykey = callbacks
+    if key not in bykey:
+        order.append(key)
+        bykey[key] = callback
+
+def _packints(values):
+    """Return the big-endian binary representation of a list of integers"""
+    a = array('i', values)
+    if sys.byteorder != 'big':
+        a.byteswap()
+    return a.tostring()
+
+def _unpackints(data):
+    """Return an array of integers from its big-endian representation"""
+    a = array('i')
+    a.fromstring(data)
+    if sys.byteorder != 'big':
+        a.byteswap()
+    return a
+
+def _markerhash(marker):
+    """Return a digest identifying a marker"""
+    return util.sha1(obsolete._encodeonemarker(marker)).digest()
+
+class obsindex(object):
+    """Integer based index of the obsolescence graph
+
+    Every node involved in a marker gets an integer identifier and every
+    (precursor, successor) relation is stored as an edge between two
+    identifiers. Identifiers are mapped to revision numbers of the unfiltered
+    changelog (-1 for unknown nodes) so the graph is walked on integers,
+    without touching binary nodes or marker tuples.
+
+    The index is stored in `.hg/cache/evolve-obsindex`. Only markers appended
+    to the obsstore since the last update are processed.
+    """
+
+    _filename = 'cache/evolve-obsindex'
+    _version = 1
+    # version, markers, nodes, mapped nodes, edges, last marker digest,
+    # changelog length and changelog tip
+    _header = '>BIIII20sI20s'
+    # number of closures memoized before the memo is cleared
+    _closurecachesize = 10000
+
+    def __init__(self, opener):
+        self._opener = opener
+        self._dirty = False
+        # number of indexed markers and digest of the last one
+        self.nbmarkers = 0
+        self.lastmarker = nullid
+        # identifier <-> node
+        self.nodes = []
+        self.ids = {}
+        # identifier <-> revision number
+        self.revs = array('i')
+        self.revids = {}
+        self._nbmapped = 0
+        # length and tip of the changelog the revisions are mapped against
+        self.cllen = 0
+        self.cltip = nullid
+        # edges: precursor identifier, successor identifier and marker flags
+        self.edgeprec = array('i')
+        self.edgesucc = array('i')
+        self.edgeflags = array('i')
+        # identifier -> indexes of edges toward its precursors or successors
+        self.precedges = {}
+        self.succedges = {}
+        # (rev, precursors, haltonflags) -> memoized transitive closure
+        self._closures = {}
+
+    @classmethod
+    def load(cls, repo):
+        """Read the index of repo from disk
+
+        An empty index is returned if the cache is missing, corrupted or does
+        not match the obsstore content."""
+        idx = cls(repo.opener)
+        try:
+            data = repo.opener.read(cls._filename)
+            idx._decode(data)
+        except (IOError, OSError):
+            return idx
+        except (struct.error, ValueError):
+            return cls(repo.opener)
+        markers = repo.obsstore._all
+        if (len(markers) < idx.nbmarkers
+            or (idx.nbmarkers and
+                _markerhash(markers[idx.nbmarkers - 1]) != idx.lastmarker)):
+            # obsstore was rewritten
+            return cls(repo.opener)
+        return idx
+
+    def _decode(self, data):
+        hsize = struct.calcsize(self._header)
+        (version, nbmarkers, nbnodes, nbmapped, nbedges, lastmarker,
+         cllen, cltip) = struct.unpack(self._header, data[:hsize])
+        if version != self._version:
+            raise ValueError('unknown obsindex version %i' % version)
+        off = hsize
+        nodes = [data[o:o + 20] for o in xrange(off, off + 20 * nbnodes, 20)]
+        off += 20 * nbnodes
+        arrays = []
+        for size in (nbnodes, nbedges, nbedges, nbedges):
+            arrays.append(_unpackints(data[off:off + 4 * size]))
+            off += 4 * size
+        if off != len(data) or len(arrays[0]) != nbnodes:
+            raise ValueError('truncated obsindex')
+        self.nbmarkers = nbmarkers
+        self.lastmarker = lastmarker
+        self.nodes = nodes
+        self.ids = dict((n, i) for i, n in enumerate(nodes))
+        self.revs, self.edgeprec, self.edgesucc, self.edgeflags = arrays
+        self.revids = dict((r, i) for i, r in enumerate(self.revs) if r >= 0)
+        self._nbmapped = nbmapped
+        self.cllen = cllen
+        self.cltip = cltip
+        for e in xrange(nbedges):
+            self.precedges.setdefault(self.edgesucc[e], []).append(e)
+            self.succedges.setdefault(self.edgeprec[e], []).append(e)
+
+    def write(self):
+        if not self._dirty:
+            return
+        try:
+            f = self._opener(self._filename, 'w', atomictemp=True)
+            f.write(struct.pack(self._header, self._version, self.nbmarkers,
+                                len(self.nodes), self._nbmapped,
+                                len(self.edgeprec),
+                                self.lastmarker, self.cllen, self.cltip))
+            f.write(''.join(self.nodes))
+            for a in (self.revs, self.edgeprec, self.edgesucc,
+                      self.edgeflags):
+                f.write(_packints(a))
+            f.close()
+            self._dirty = False
+        except (IOError, OSError, util.Abort):
+            # Abort may be raise by read only opener
+            pass
+
+    def _nodeid(self, node):
+        """Return the identifier of a node, allocating one if needed"""
+        i = self.ids.get(node)
+        if i is None:
+            i = self.ids[node] = len(self.nodes)
+            self.nodes.append(node)
+            self.revs.append(-1)
+        return i
+
+    def addmarkers(self, markers):
+        """Index markers appended to the obsstore"""
+        last = None
+        nodeid = self._nodeid
+        known = self.nbmarkers
+        for mark in markers:
+            prec = nodeid(mark[0])
+            for suc in mark[1]:
+                if suc == nullid:
+                    continue # should not be here!
+                suc = nodeid(suc)
+                e = len(self.edgeprec)
+                self.edgeprec.append(prec)
+                self.edgesucc.append(suc)
+                self.edgeflags.append(mark[2])
+                self.precedges.setdefault(suc, []).append(e)
+                self.succedges.setdefault(prec, []).append(e)
+            self.nbmarkers += 1
+            last = mark
+        _profiler.count('markers.indexed', self.nbmarkers - known)
+        if last is not None:
+            self.lastmarker = _markerhash(last)
+            self._closures.clear()
+            self._dirty = True
+
+    def _maprevs(self, cl):
+        """Map identifiers to revision numbers of changelog <cl>"""
+        cllen = len(cl)
+        cltip = cllen and cl.node(cllen - 1) or nullid
+        revs = self.revs
+        revids = self.revids
+        torev = cl.nodemap.get
+        if (cllen < self.cllen
+            or (self.cllen and cl.node(self.cllen - 1) != self.cltip)):
+            # history was stripped, everything must be mapped again
+            revids.clear()
+            for i in xrange(len(revs)):
+                revs[i] = -1
+            self._nbmapped = 0
+            self.cllen = 0
+        if self.cllen < cllen:
+            # only look up nodes of the new revisions
+            getid = self.ids.get
+            for r in xrange(self.cllen, cllen):
+                i = getid(cl.node(r))
+                if i is not None and i < self._nbmapped:
+                    revs[i] = r
+                    revids[r] = i
+        for i in xrange(self._nbmapped, len(self.nodes)):
+            r = torev(self.nodes[i])
+            if r is not None:
+                revs[i] = r
+                revids[r] = i
+        if (self.cllen, self.cltip) != (cllen, cltip) or \
+           self._nbmapped != len(self.nodes):
+            self._dirty = True
+        self._nbmapped = len(self.nodes)
+        self.cllen = cllen
+        self.cltip = cltip
+        self._closures.clear()
+
+    def closure(self, rev, precursors=False, haltonflags=0):
+        """Return the set of transitive successors of <rev>
+
+        Transitive precursors are returned instead if <precursors> is True.
+        Markers with one of <haltonflags> set are not followed. The result is
+        memoized until markers are added or the changelog changes, up to
+        `_closurecachesize` closures."""
+        key = (rev, precursors, haltonflags)
+        cs = self._closures.get(key)
+        if cs is not None:
+            _profiler.count('closure.hit')
+        else:
+            _profiler.count('closure.miss')
+            if precursors:
+                adjacent, edgenext = self.precedges, self.edgeprec
+            else:
+                adjacent, edgenext = self.succedges, self.edgesucc
+            edgeflags = self.edgeflags
+            toproceed = [self.revids.get(rev)]
+            seen = set()
+            while toproceed:
+                nc = toproceed.pop()
+                for e in adjacent.get(nc, ()):
+                    if edgeflags[e] & haltonflags:
+                        continue
+                    n = edgenext[e]
+                    if n not in seen:
+                        seen.add(n)
+                        toproceed.append(n)
+            revs = self.revs
+            cs = frozenset(r for r in (revs[i] for i in seen) if r >= 0)
+            if len(self._closures) >= self._closurecachesize:
+                self._closures.clear()
+            self._closures[key] = cs
+        return cs
+
+    def update(self, repo):
+        """Bring the index up to date with obsstore and changelog of repo"""
+        markers = repo.obsstore._all
+        uptodate = True
+        if self.nbmarkers < len(markers):
+            self.addmarkers(markers.iterfrom(self.nbmarkers))
+            uptodate = False
+        cl = repo.changelog
+        if (self._nbmapped != len(self.nodes) or len(cl) != self.cllen
+            or (self.cllen and cl.node(self.cllen - 1) != self.cltip)):
+            self._maprevs(cl)
+            uptodate = False
+        _profiler.count(uptodate and 'obsindex.hit' or 'obsindex.miss')
+        if self._dirty:
+            tr = _currenttransaction(repo)
+            if tr is None:
+                self.write()
+            else:
+                _ontransactionclose(tr, 'evolve-obsindex', self.write)
+
+def _obsindex(repo):
+    """Return the up to date obsolescence index of a repository"""
+    repo = repo.unfiltered()
+    store = repo.obsstore
+    idx = getattr(store, 'evolveindex', None)
+    if idx is None:
+        idx = store.evolveindex = obsindex.load(repo)
+    idx.update(repo)
+    return idx
+
+class knownmarkers(object):
+    """Stand-in for the `_all` list of an obsstore during `obsstore.add`
+
+    Core filters out known markers with `set(self._all)`, which decodes
+    every marker of a `compactmarkers`. Only markers sharing a precursor
+    with the added ones are iterated here. The store gets its markers back
+    before the new ones are loaded, see `_obsstoreload`.
+    """
+
+    def __init__(self, markers, added):
+        self.markers = markers
+        self._added = added
+
+    def __iter__(self):
+        markers = self.markers
+        for pre in set(m[0] for m in self._added):
+            for i in markers.successors.indexes(pre):
+                yield markers.marker(i)
+
+@eh.wrapfunction(obsolete.obsstore, 'add')
+def _obsstoreadd(orig, store, transaction, markers):
+    """Index new markers in the transaction adding them
+
+    The troubled cache is refreshed when the transaction is closed. Known
+    markers are looked up through the precursor index, see
+    `knownmarkers`."""
+    known = len(store._all)
+    stored = store._all
+    if isinstance(stored, compactmarkers):
+        markers = list(markers)
+        store._all = knownmarkers(stored, markers)
+    try:
+        new = orig(store, transaction, markers)
+    finally:
+        if isinstance(store._all, knownmarkers):
+            store._all = stored
+    idx = getattr(store, 'evolveindex', None)
+    if new and idx is not None and idx.nbmarkers == known:
+        idx.addmarkers(store._all[known:])
+        _ontransactionclose(transaction, 'evolve-obsindex', idx.write)
+    cache = getattr(store, 'evolvetroubled', None)
+    if new and cache is not None:
+        _ontransactionclose(transaction, 'evolve-troubled-refresh',
+                            cache.refresh)
+    return new
+
+# the two checks below evaluate a single mutable and non-obsolete revision
+# the way `obsolete._computebumpedset` and `obsolete._computedivergentset`
+# evaluate every one of them
+
+def _isbumped(repo, rev, newermap):
+    torev = repo.changelog.nodemap.get
+    phase = repo._phasecache.phase
+    for pnode in obsolete.allprecursors(repo.obsstore,
+                                        [repo.changelog.node(rev)],
+                                        ignoreflags=obsolete.bumpedfix):
+        prev = torev(pnode)
+        if prev is not None and phase(repo, prev) <= phases.public:
+            return True
+    return False
+
+def _isdivergent(repo, rev, newermap):
+    store = repo.obsstore
+    toprocess = set(store.precursors.get(repo.changelog.node(rev), ()))
+    while toprocess:
+        prec = toprocess.pop()[0]
+        if prec not in newermap:
+            obsolete.successorssets(repo, prec, newermap)
+        if len([n for n in newermap[prec] if n]) > 1:
+            return True
+        toprocess.update(store.precursors.get(prec, ()))
+    return False
+
+# flags of a revision in the troubled cache
+_troubleflags = [('unstable', 1), ('bumped', 2), ('divergent', 4),
+                 ('obsolete', 8)]
+_troubledmask = 1 | 2 | 4
+
+class troubledcache(object):
+    """Cache of troubled revisions
+
+    Troubles of the unfiltered repository are stored as a bytearray holding
+    one byte of `_troubleflags` per revision. Counts of troubled changesets
+    visible at each filter level are derived from it and kept until the
+    filtered revisions change.
+
+    The cache is keyed on changelog, obsstore and phase roots content. It is
+    stored in `.hg/cache/evolve-troubled`. New changesets, markers appended
+    to the obsstore and moved phase boundaries only update the revisions
+    whose troubles they may change, see `_refresh`. Everything is recomputed
+    when history is stripped or the obsstore rewritten.
+    """
+
+    _filename = 'cache/evolve-troubled'
+    _version = 1
+    # version, changelog length and tip, markers, last marker digest and
+    # number of draft and secret roots
+    _header = '>BI20sI20sII'
+
+    def __init__(self, repo):
+        self._repo = weakref.ref(repo)
+        self._opener = repo.opener
+        self._dirty = False
+        self.key = None
+        self.flags = bytearray()
+        # filtername -> (filteredrevs, counts)
+        self._counts = {}
+
+    @classmethod
+    def load(cls, repo):
+        cache = cls(repo)
+        try:
+            data = repo.opener.read(cls._filename)
+            hsize = struct.calcsize(cls._header)
+            header = struct.unpack(cls._header, data[:hsize])
+            if header[0] != cls._version:
+                raise ValueError('unknown troubled cache version %i'
+                                 % header[0])
+            roots = []
+            off = hsize
+            for nbroots in header[5:]:
+                end = off + 20 * nbroots
+                roots.append(frozenset(data[o:o + 20]
+                                       for o in xrange(off, end, 20)))
+                off = end
+            entries = _unpackints(data[off:])
+        except (IOError, OSError, struct.error, ValueError):
+            return cache
+        flags = bytearray(header[1])
+        try:
+            for i in xrange(0, len(entries), 2):
+                flags[entries[i]] = entries[i + 1]
+        except (IndexError, ValueError):
+            return cache
+        cache.key = header[1:5] + (tuple(roots),)
+        cache.flags = flags
+        return cache
+
+    def write(self):
+        if not self._dirty:
+            return
+        try:
+            f = self._opener(self._filename, 'w', atomictemp=True)
+            roots = self.key[4]
+            f.write(struct.pack(self._header, self._version,
+                                *(self.key[:4] + tuple(map(len, roots)))))
+            for phaseroots in roots:
+                f.write(''.join(sorted(phaseroots)))
+            entries = []
+            for r, v in enumerate(self.flags):
+                if v:
+                    entries.append(r)
+                    entries.append(v)
+            f.write(_packints(entries))
+            f.close()
+            self._dirty = False
+        except (IOError, OSError, util.Abort):
+            # Abort may be raise by read only opener
+            pass
+
+    def _computekey(self, repo):
+        """Key of the state troubles derive from
+
+        Only made of facts at hand: the obsolescence index is not needed to
+        tell the cache is up to date."""
+        cl = repo.changelog
+        cllen = len(cl)
+        markers = repo.obsstore._all
+        roots = tuple(frozenset(r)
+                      for r in repo._phasecache.phaseroots[phases.draft:])
+        return (cllen, cllen and cl.node(cllen - 1) or nullid, len(markers),
+                markers and _markerhash(markers[-1]) or nullid, roots)
+
+    def _refresh(self, repo, key):
+        """Update flags of revisions whose troubles may have changed since
+        the cache was computed, return False if not possible
+
+        Those are new revisions, revisions whose phase moved and successors
+        of the precursors of all of them and of new markers: obsolescence,
+        bumping and divergence depend on them. Unstable revisions are then
+        re-evaluated for descendants of revisions becoming obsolete or not.
+        """
+        cl = repo.changelog
+        store = repo.obsstore
+        markers = store._all
+        oldlen, oldtip, oldnbmarkers, oldlast, oldroots = self.key
+        if (key[0] < oldlen or (oldlen and cl.node(oldlen - 1) != oldtip)
+            or key[2] < oldnbmarkers
+            or (oldnbmarkers
+                and _markerhash(markers[oldnbmarkers - 1]) != oldlast)):
+            # history was stripped or the obsstore rewritten
+            return False
+        torev = cl.nodemap.get
+        phase = repo._phasecache.phase
+        flags = self.flags
+        flags.extend(bytearray(key[0] - oldlen))
+        changed = set(xrange(oldlen, key[0]))
+        for old, new in zip(oldroots, key[4]):
+            if old != new:
+                # revisions in exactly one of `old::` and `new::`
+                for roots in (old - new, new - old):
+                    revs = [r for r in map(torev, roots) if r is not None]
+                    if revs:
+                        changed.update(revs)
+                        changed.update(cl.descendants(revs))
+        nodes = set(m[0] for m in markers[oldnbmarkers:])
+        nodes.update(cl.node(r) for r in changed)
+        related = obsolete.allsuccessors(store,
+                                         obsolete.allprecursors(store, nodes))
+        changed.update(r for r in map(torev, related) if r is not None)
+        succs = store.successors
+        obschanged = []
+        for rev in changed:
+            obs = bool(phase(repo, rev) and cl.node(rev) in succs)
+            if obs != bool(flags[rev] & 8):
+                obschanged.append(rev)
+        tocheck = set(changed)
+        if obschanged:
+            tocheck.update(cl.descendants(obschanged))
+        newermap = {}
+        for rev in sorted(tocheck):
+            if rev not in changed:
+                value = flags[rev] & (2 | 4 | 8)
+            elif not phase(repo, rev):
+                value = 0
+            elif cl.node(rev) in succs:
+                value = 8
+            else:
+                value = 0
+                if _isbumped(repo, rev, newermap):
+                    value |= 2
+                if _isdivergent(repo, rev, newermap):
+                    value |= 4
+            if not value & 8:
+                for p in cl.parentrevs(rev):
+                    if p >= 0 and flags[p] & (1 | 8): # unstable or obsolete
+                        value |= 1
+                        break
+            flags[rev] = value
+        return True
+
+    def update(self, repo):
+        """Bring the cache up to date with repo (unfiltered)"""
+        key = self._computekey(repo)
+        if key == self.key:
+            _profiler.count('troubled.hit')
+            return
+        if self.key is not None and self._refresh(repo, key):
+            _profiler.count('troubled.refresh')
+        else:
+            _profiler.count('troubled.miss')
+            flags = bytearray(key[0])
+            for name, flag in _troubleflags:
+                for r in getrevs(repo, name):
+                    flags[r] |= flag
+            self.flags = flags
+        self.key = key
+        self._counts.clear()
+        self._dirty = True
+        tr = _currenttransaction(repo)
+        if tr is None:
+            self.write()
+        else:
+            _ontransactionclose(tr, 'evolve-troubled', self.write)
+
+    def refresh(self):
+        """Update the cache of a repository still alive
+
+        Called when a transaction adding markers is closed."""
+        repo = self._repo()
+        if repo is not None:
+            self.update(repo)
+
+    def counts(self, repo):
+        """Return the number of unstable, bumped, divergent and troubled
+        changesets visible in repo"""
+        filtered = repo.changelog.filteredrevs
+        cached = self._counts.get(repo.filtername)
+        if cached is not None and cached[0] is filtered:
+            return cached[1]
+        flags = self.flags
+        histogram = [flags.count(chr(v)) for v in xrange(16)]
+        for r in filtered:
+            if r < len(flags) and flags[r]:
+                histogram[flags[r]] -= 1
+        counts = []
+        for name, flag in _troubleflags[:3]:
+            counts.append(sum(c for v, c in enumerate(histogram) if v & flag))
+        counts.append(sum(c for v, c in enumerate(histogram)
+                          if v & _troubledmask))
+        counts = tuple(counts)
+        self._counts[repo.filtername] = (filtered, counts)
+        return counts
+
+def _phasedigest(repo):
+    """Digest of the phase roots of repo"""
+    phasehash = util.sha1()
+    for roots in repo._phasecache.phaseroots:
+        phasehash.update(''.join(sorted(roots)) + '\0')
+    return phasehash.digest()
+
+def _troubledcounts(repo):
+    """Return the number of unstable, bumped, divergent and troubled
+    changesets visible in repo"""
+    unfi = repo.unfiltered()
+    store = unfi.obsstore
+    if not store:
+        return (0, 0, 0, 0)
+    cache = getattr(store, 'evolvetroubled', None)
+    if cache is None:
+        cache = store.evolvetroubled = troubledcache.load(unfi)
+    cache.update(unfi)
+    return cache.counts(repo)
+
+# The command server invalidates the repository before every command,
+# dropping the obsolescence sets cached by `getrevs` even when nothing
+# changed. The obsstore object itself survives as long as its file is
+# unchanged, so sets are also saved on it with the state they were computed
+# from, and reused when a command finds the same state.
+
+def _obsstatekey(repo):
+    """Key of the state obsolescence sets of repo (unfiltered) derive from
+
+    Made of the size and mtime of the obsstore file, the number of markers,
+    changelog length and tip and the phase roots."""
+    try:
+        st = os.stat(repo.sjoin('obsstore'))
+        filekey = (st.st_size, st.st_mtime)
+    except OSError:
+        filekey = None
+    cl = repo.changelog
+    return (filekey, len(repo.obsstore._all), len(cl), cl.tip(),
+            _phasedigest(repo))
+
+@eh.wrapfunction(obsolete, 'getrevs')
+def _getrevs(orig, repo, name):
+    """Reuse sets computed by a previous command for the same state"""
+    repo = repo.unfiltered()
+    store = repo.obsstore
+    if not store or name in store.caches:
+        return orig(repo, name)
+    saved = getattr(store, 'evolvesavedsets', None)
+    if saved is None:
+        saved = store.evolvesavedsets = {}
+    key = _obsstatekey(repo)
+    entry = saved.get(name)
+    if entry is not None and entry[0] == key:
+        _profiler.count('obssets.hit')
+        store.caches[name] = entry[1]
+        return entry[1]
+    _profiler.count('obssets.miss')
+    revs = orig(repo, name)
+    saved[name] = (key, revs)
+    return revs
 
 #####################################################################
 ### Additional Utilities                                          ###
@@ -359,6 +1600,7 @@ def _installalias(ui):
 ### Troubled revset symbol
 
 @eh.revset('troubled')
+@_profiled('revset.troubled')
 def revsettroubled(repo, subset, x):
     """``troubled()``
     Changesets with troubles.
@@ -375,46 +1617,39 @@ def revsettroubled(repo, subset, x):
 def _precursors(repo, s):
     """Precursor of a changeset"""
     cs = set()
-    nm = repo.changelog.nodemap
-    markerbysubj = repo.obsstore.precursors
+    idx = _obsindex(repo)
+    revs = idx.revs
+    getid = idx.revids.get
+    edgeprec = idx.edgeprec
+    precedges = idx.precedges
     for r in s:
-        for p in markerbysubj.get(repo[r].node(), ()):
-            pr = nm.get(p[0])
-            if pr is not None:
+        for e in precedges.get(getid(r), ()):
+            pr = revs[edgeprec[e]]
+            if pr >= 0:
                 cs.add(pr)
     return cs
 
 def _allprecursors(repo, s):  # XXX we need a better naming
     """transitive precursors of a subset"""
-    toproceed = [repo[r].node() for r in s]
-    seen = set()
-    allsubjects = repo.obsstore.precursors
-    while toproceed:
-        nc = toproceed.pop()
-        for mark in allsubjects.get(nc, ()):
-            np = mark[0]
-            if np not in seen:
-                seen.add(np)
-                toproceed.append(np)
-    nm = repo.changelog.nodemap
-    cs = set()
-    for p in seen:
-        pr = nm.get(p)
-        if pr is not None:
-            cs.add(pr)
-    return cs
+    closure = _obsindex(repo).closure
+    sets = [closure(r, precursors=True) for r in s]
+    if len(sets) == 1:
+        return sets[0]
+    return set().union(*sets)
 
 def _successors(repo, s):
     """Successors of a changeset"""
     cs = set()
-    nm = repo.changelog.nodemap
-    markerbyobj = repo.obsstore.successors
+    idx = _obsindex(repo)
+    revs = idx.revs
+    getid = idx.revids.get
+    edgesucc = idx.edgesucc
+    succedges = idx.succedges
     for r in s:
-        for p in markerbyobj.get(repo[r].node(), ()):
-            for sub in p[1]:
-                sr = nm.get(sub)
-                if sr is not None:
-                    cs.add(sr)
+        for e in succedges.get(getid(r), ()):
+            sr = revs[edgesucc[e]]
+            if sr >= 0:
+                cs.add(sr)
     return cs
 
 def _allsuccessors(repo, s, haltonflags=0):  # XXX we need a better naming
@@ -422,27 +1657,11 @@ def _allsuccessors(repo, s, haltonflags=0):  # XXX we need a better naming
 
     haltonflags allows to provide flags which prevent the evaluation of a
     marker.  """
-    toproceed = [repo[r].node() for r in s]
-    seen = set()
-    allobjects = repo.obsstore.successors
-    while toproceed:
-        nc = toproceed.pop()
-        for mark in allobjects.get(nc, ()):
-            if mark[2] & haltonflags:
-                continue
-            for sub in mark[1]:
-                if sub == nullid:
-                    continue # should not be here!
-                if sub not in seen:
-                    seen.add(sub)
-                    toproceed.append(sub)
-    nm = repo.changelog.nodemap
-    cs = set()
-    for s in seen:
-        sr = nm.get(s)
-        if sr is not None:
-            cs.add(sr)
-    return cs
+    closure = _obsindex(repo).closure
+    sets = [closure(r, haltonflags=haltonflags) for r in s]
+    if len(sets) == 1:
+        return sets[0]
+    return set().union(*sets)
 
 
 
@@ -454,55 +1673,83 @@ def _allsuccessors(repo, s, haltonflags=0):  # XXX we need a better naming
 # this section add several useful revset symbol not yet in core.
 # they are subject to changes
 
+def _revsetspan(repo):
+    """Return all revisions of repo as a revset subset"""
+    if util.safehasattr(revset, 'spanset'):
+        return revset.spanset(repo)
+    return range(len(repo))
+
+def _revsetfilter(subset, revs):
+    """Return the members of <subset> which are in the <revs> set
+
+    When <subset> is an ordered smartset, the result lazily iterates over
+    the sorted content of <revs>, testing membership in <subset>. The cost
+    then depends on the size of <revs> instead of the size of <subset>.
+    """
+    if not util.safehasattr(subset, 'isascending'):
+        return [r for r in subset if r in revs]
+    if subset.isascending():
+        candidates = revset.baseset(sorted(revs))
+        return revset.orderedlazyset(candidates, subset.__contains__)
+    if subset.isdescending():
+        candidates = revset.baseset(sorted(revs, reverse=True))
+        return revset.orderedlazyset(candidates, subset.__contains__,
+                                     ascending=False)
+    return subset.filter(revs.__contains__)
 
 ### XXX I'm not sure this revset is useful
 @eh.revset('suspended')
+@_profiled('revset.suspended')
 def revsetsuspended(repo, subset, x):
     """``suspended()``
     Obsolete changesets with non-obsolete descendants.
     """
     args = revset.getargs(x, 0, 0, 'suspended takes no arguments')
     suspended = getrevs(repo, 'suspended')
-    return [r for r in subset if r in suspended]
+    return _revsetfilter(subset, suspended)
 
 
 @eh.revset('precursors')
+@_profiled('revset.precursors')
 def revsetprecursors(repo, subset, x):
     """``precursors(set)``
     Immediate precursors of changesets in set.
     """
-    s = revset.getset(repo, range(len(repo)), x)
+    s = revset.getset(repo, _revsetspan(repo), x)
     cs = _precursors(repo, s)
-    return [r for r in subset if r in cs]
+    return _revsetfilter(subset, cs)
 
 
 @eh.revset('allprecursors')
+@_profiled('revset.allprecursors')
 def revsetallprecursors(repo, subset, x):
     """``allprecursors(set)``
     Transitive precursors of changesets in set.
     """
-    s = revset.getset(repo, range(len(repo)), x)
+    s = revset.getset(repo, _revsetspan(repo), x)
     cs = _allprecursors(repo, s)
-    return [r for r in subset if r in cs]
+    return _revsetfilter(subset, cs)
 
 
 @eh.revset('successors')
+@_profiled('revset.successors')
 def revsetsuccessors(repo, subset, x):
     """``successors(set)``
     Immediate successors of changesets in set.
     """
-    s = revset.getset(repo, range(len(repo)), x)
+    s = revset.getset(repo, _revsetspan(repo), x)
     cs = _successors(repo, s)
-    return [r for r in subset if r in cs]
+    return _revsetfilter(subset, cs)
 
 @eh.revset('allsuccessors')
+@_profiled('revset.allsuccessors')
 def revsetallsuccessors(repo, subset, x):
     """``allsuccessors(set)``
     Transitive successors of changesets in set.
     """
-    s = revset.getset(repo, range(len(repo)), x)
+    s = revset.getset(repo, _revsetspan(repo), x)
     cs = _allsuccessors(repo, s)
-    return [r for r in subset if r in cs]
+    return _revsetfilter(subset, cs)
 
 ### template keywords
 # XXX it does not handle troubles well :-/
@@ -531,6 +1778,7 @@ def obsoletekw(repo, ctx, templ, **args):
 @eh.wrapcommand("update")
 @eh.wrapcommand("parents")
 @eh.wrapcommand("pull")
+@_profiled('wrapmayobsoletewc')
 def wrapmayobsoletewc(origfn, ui, repo, *args, **opts):
     """Warn that the working directory parent is an obsolete changeset"""
     res = origfn(ui, repo, *args, **opts)
@@ -547,21 +1795,18 @@ def wrapmayobsoletewc(origfn, ui, repo, *args, **opts):
 @eh.wrapcommand("graft")
 @eh.wrapcommand("phase")
 @eh.wrapcommand("unbundle")
+@_profiled('warnobserrors')
 def warnobserrors(orig, ui, repo, *args, **kwargs):
     """display warning is the command resulted in more instable changeset"""
     # part of the troubled stuff may be filtered (stash ?)
-    # This needs a better implementation but will probably wait for core.
-    filtered = repo.changelog.filteredrevs
-    priorunstables = len(set(getrevs(repo, 'unstable')) - filtered)
-    priorbumpeds = len(set(getrevs(repo, 'bumped')) - filtered)
-    priordivergents = len(set(getrevs(repo, 'divergent')) - filtered)
+    priorunstables, priorbumpeds, priordivergents = _troubledcounts(repo)[:3]
     ret = orig(ui, repo, *args, **kwargs)
     # workaround phase stupidity
     #phases._filterunknown(ui, repo.changelog, repo._phasecache.phaseroots)
-    filtered = repo.changelog.filteredrevs
-    newunstables = len(set(getrevs(repo, 'unstable')) - filtered) - priorunstables
-    newbumpeds = len(set(getrevs(repo, 'bumped')) - filtered) - priorbumpeds
-    newdivergents = len(set(getrevs(repo, 'divergent')) - filtered) - priordivergents
+    unstables, bumpeds, divergents = _troubledcounts(repo)[:3]
+    newunstables = unstables - priorunstables
+    newbumpeds = bumpeds - priorbumpeds
+    newdivergents = divergents - priordivergents
     if newunstables > 0:
         ui.warn(_('%i new unstable changesets\n') % newunstables)
     if newbumpeds > 0:
@@ -593,6 +1838,7 @@ def _repostabilizesetup(ui, repo):
             return result
     repo.__class__ = evolvingrepo
 
+@_profiled('summaryhook')
 def summaryhook(ui, repo):
     def write(fmt, count):
         s = fmt % count
@@ -601,9 +1847,7 @@ def summaryhook(ui, repo):
         else:
             ui.note(s)
 
-    nbunstable = len(getrevs(repo, 'unstable'))
-    nbbumped = len(getrevs(repo, 'bumped'))
-    nbdivergent = len(getrevs(repo, 'divergent'))
+    nbunstable, nbbumped, nbdivergent = _troubledcounts(repo.unfiltered())[:3]
     write('unstable: %i changesets\n', nbunstable)
     write('bumped: %i changesets\n', nbbumped)
     write('divergent: %i changesets\n', nbdivergent)
@@ -647,6 +1891,24 @@ def _rebasewrapping(ui):
 ### changeset rewriting logic
 #############################
 
+class lazymemfilectx(context.memfilectx):
+    """memfilectx reading the content of <fctx> only when it is committed
+
+    The content is not kept afterward, so that committing many large files
+    only holds one of them in memory at a time.
+    """
+
+    def __init__(self, fctx, path=None, copied=None):
+        flags = fctx.flags()
+        super(lazymemfilectx, self).__init__(path or fctx.path(), None,
+                                             islink='l' in flags,
+                                             isexec='x' in flags,
+                                             copied=copied)
+        self._fctx = fctx
+
+    def data(self):
+        return self._fctx.data()
+
 def rewrite(repo, old, updates, head, newbases, commitopts):
     """Return (nodeid, created) where nodeid is the identifier of the
     changeset generated by the rewrite process, and created is True if
@@ -668,33 +1930,27 @@ def rewrite(repo, old, updates, head, newbases, commitopts):
             files.update(u.files())
 
         # Recompute copies (avoid recording a -> b -> a)
-        copied = copies.pathcopies(base, head)
+        copied = _pathcopies(repo, base, head)
 
 
         # prune files which were reverted by the updates
+        headmf = head.manifest()
+        basemf = base.manifest()
         def samefile(f):
-            if f in head.manifest():
-                a = head.filectx(f)
-                if f in base.manifest():
-                    b = base.filectx(f)
-                    return (a.data() == b.data()
-                            and a.flags() == b.flags())
-                else:
+            if f in headmf:
+                if f not in basemf or headmf.flags(f) != basemf.flags(f):
                     return False
+                if headmf[f] == basemf[f]:
+                    # same file revision, content is not read
+                    return True
+                return not head.filectx(f).cmp(base.filectx(f))
             else:
-                return f not in base.manifest()
+                return f not in basemf
         files = [f for f in files if not samefile(f)]
         # commit version of these files as defined by head
-        headmf = head.manifest()
         def filectxfn(repo, ctx, path):
             if path in headmf:
-                fctx = head[path]
-                flags = fctx.flags()
-                mctx = context.memfilectx(fctx.path(), fctx.data(),
-                                          islink='l' in flags,
-                                          isexec='x' in flags,
-                                          copied=copied.get(path))
-                return mctx
+                return lazymemfilectx(head[path], copied=copied.get(path))
             raise IOError()
         if commitopts.get('message') and commitopts.get('logfile'):
             raise util.Abort(_('options --message and --logfile are mutually'
@@ -757,14 +2013,29 @@ def relocate(repo, orig, dest):
         try:
             wlock = repo.wlock()
             lock = repo.lock()
-            r = rebase.rebasenode(repo, orig.node(), dest.node(),
-                                  {node.nullrev: node.nullrev}, False)
-            if r[-1]: #some conflict
-                raise util.Abort(
+            relocated = _relocatememory(repo, orig, dest)
+            if relocated is not None:
+                # no conflict, the working directory is only updated once.
+                # Output of the commit follows the update, as it follows the
+                # working directory merge.
+                repo.ui.pushbuffer()
+                try:
+                    nodenew = _commitrelocated(repo, relocated)
+                except:
+                    repo.ui.write(repo.ui.popbuffer())
+                    raise
+                output = repo.ui.popbuffer()
+                merge.update(repo, nodenew or dest.node(), False, True, False)
+                repo.ui.write(output)
+            else:
+                r = rebase.rebasenode(repo, orig.node(), dest.node(),
+                                      {node.nullrev: node.nullrev}, False)
+                if r[-1]: #some conflict
+                    raise util.Abort(
                         'unresolved merge conflicts (see hg help resolve)')
-            cmdutil.duplicatecopies(repo, orig.node(), dest.node())
-            nodenew = rebase.concludenode(repo, orig.node(), dest.node(),
-                                          node.nullid)
+                cmdutil.duplicatecopies(repo, orig.node(), dest.node())
+                nodenew = rebase.concludenode(repo, orig.node(), dest.node(),
+                                              node.nullid)
         except util.Abort, exc:
             class LocalMergeFailure(MergeFailure, exc.__class__):
                 pass
@@ -772,27 +2043,440 @@ def relocate(repo, orig, dest):
             raise
         finally:
             lockmod.release(lock, wlock)
-        oldbookmarks = repo.nodebookmarks(nodesrc)
-        if nodenew is not None:
-            phases.retractboundary(repo, destphase, [nodenew])
-            createmarkers(repo, [(repo[nodesrc], (repo[nodenew],))])
-            for book in oldbookmarks:
-                repo._bookmarks[book] = nodenew
-        else:
-            createmarkers(repo, [(repo[nodesrc], ())])
-            # Behave like rebase, move bookmarks to dest
-            for book in oldbookmarks:
-                repo._bookmarks[book] = dest.node()
-        for book in destbookmarks: # restore bookmark that rebase move
-            repo._bookmarks[book] = dest.node()
-        if oldbookmarks or destbookmarks:
-            repo._bookmarks.write()
+        if _relocatemarkers(repo, nodesrc, destphase, dest, nodenew,
+                            destbookmarks):
+            _writebookmarks(repo)
         return nodenew
     except util.Abort:
         # Invalidate the previous setparents
         repo.dirstate.invalidate()
         raise
 
+def _relocatemarkers(repo, nodesrc, destphase, dest, nodenew, destbookmarks):
+    """Obsolete <nodesrc> by its relocated version <nodenew> on <dest>
+
+    Bookmarks are moved in memory. Return True if they need to be written.
+    """
+    oldbookmarks = repo.nodebookmarks(nodesrc)
+    if nodenew is not None:
+        _retractboundary(repo, destphase, [nodenew])
+        createmarkers(repo, [(repo[nodesrc], (repo[nodenew],))])
+        for book in oldbookmarks:
+            repo._bookmarks[book] = nodenew
+    else:
+        createmarkers(repo, [(repo[nodesrc], ())])
+        # Behave like rebase, move bookmarks to dest
+        for book in oldbookmarks:
+            repo._bookmarks[book] = dest.node()
+    for book in destbookmarks: # restore bookmark that rebase move
+        repo._bookmarks[book] = dest.node()
+    return bool(oldbookmarks or destbookmarks)
+
+def _premerges(repo, path):
+    """Tell if the merge tool picked for <path> starts with a simple merge
+
+    Files for which it does not (or with encode/decode filters) can not
+    be merged in memory.
+    """
+    ui = repo.ui
+    if ui.configitems('encode') or ui.configitems('decode'):
+        return False
+    ui.pushbuffer()
+    try:
+        tool, toolpath = filemerge._picktool(repo, ui, path, False, False)
+    finally:
+        ui.popbuffer()
+    if tool in filemerge.internals and tool != 'internal:merge':
+        return False
+    try:
+        return filemerge._toolbool(ui, tool, 'premerge', True)
+    except error.ConfigError:
+        return True # 'keep' still premerges
+
+def _mergetext(fca, fcl, fco):
+    """Merge the content of a file changed on both sides, in memory
+
+    Return the merged text, or None on conflicts or binary files.
+    """
+    if fca.isbinary() or fcl.isbinary() or fco.isbinary():
+        return None
+    m3 = simplemerge.Merge3Text(fca.data(), fcl.data(), fco.data())
+    text = ''.join(m3.merge_lines(reprocess=True))
+    if m3.conflicts:
+        return None
+    return text
+
+def _mergeworker(base, local, other, tmpdir, files):
+    """Merge a slice of <files>, given as (index, path) pairs
+
+    Merged texts are written in <tmpdir>, named after their index. Only
+    the outcome goes through the `worker` pipe: writes larger than
+    PIPE_BUF from several workers would interleave."""
+    for i, f in files:
+        text = _mergetext(base[f], local[f], other[f])
+        if text is None:
+            yield 0, f
+        else:
+            util.writefile(os.path.join(tmpdir, str(i)), text)
+            yield 1, str(i)
+
+def _mergetexts(repo, base, local, other, files):
+    """Merge <files> changed on both sides, in memory
+
+    Merges are spread over worker processes when worthwhile, see the
+    `worker.numcpus` option. Return a {path: text} mapping, or None if
+    any of the files can not be merged without the working directory.
+    """
+    for f in files:
+        if not _premerges(repo, f):
+            return None
+    texts = {}
+    failed = False
+    tmpdir = tempfile.mkdtemp(prefix='hg-evolve-')
+    try:
+        # results must all be read for the workers to terminate properly
+        for ok, item in worker.worker(repo.ui, 0.01, _mergeworker,
+                                      (base, local, other, tmpdir),
+                                      list(enumerate(files))):
+            if not ok:
+                failed = True
+            elif not failed:
+                texts[files[int(item)]] = util.readfile(
+                    os.path.join(tmpdir, item))
+    finally:
+        shutil.rmtree(tmpdir, True)
+    if failed:
+        return None
+    return texts
+
+def _memorymerge(repo, base, local, other):
+    """Merge changes from <base> to <other> into <local> using manifests
+
+    Return a {path: filectx} mapping of files to commit on top of <local>,
+    None values standing for removed files, and the list of files merged
+    on both sides. Return None if the working directory is needed.
+    """
+    bmf, lmf, omf = base.manifest(), local.manifest(), other.manifest()
+    if base == other.p1():
+        files = other.files()
+    else:
+        m, a, r = repo.status(base, other)[:3]
+        files = m + a + r
+    merged = {}
+    bothchanged = []
+    for f in files:
+        o = (omf.get(f), omf.flags(f))
+        b = (bmf.get(f), bmf.flags(f))
+        if o == b:
+            continue
+        l = (lmf.get(f), lmf.flags(f))
+        if l == o:
+            continue
+        if f in ('.hgsub', '.hgsubstate'):
+            return None
+        if l == b:
+            merged[f] = o[0] is not None and other[f] or None
+            continue
+        if None in (o[0], b[0], l[0]):
+            return None
+        if l[1] != o[1] or 'l' in l[1] + b[1]:
+            return None
+        bothchanged.append(f)
+    bothchanged.sort()
+    if bothchanged:
+        texts = _mergetexts(repo, base, local, other, bothchanged)
+        if texts is None:
+            return None
+        for f in bothchanged:
+            text = texts[f]
+            if text == local[f].data():
+                continue
+            flags = omf.flags(f)
+            merged[f] = context.memfilectx(f, text, islink='l' in flags,
+                                           isexec='x' in flags)
+    return merged, bothchanged
+
+def _relocatememory(repo, orig, dest):
+    """Prepare the rebase of <orig> on <dest> without the working directory
+
+    Return a (memctx, textmerged) tuple, memctx being None if there is
+    nothing left to commit, or None if the working directory is needed to
+    merge. Once committed, the memctx is identical to what the working
+    directory merge would create.
+    """
+    base = orig.p1()
+    result = _memorymerge(repo, base, dest, orig)
+    if result is None:
+        return None
+    merged, textmerged = result
+    if not merged:
+        return None, textmerged
+    # copies touching a merged file are left to the regular merge logic,
+    # which propagates changes across them
+    basemf, destmf = base.manifest(), dest.manifest()
+    for src in _pathcopies(repo, base, dest).itervalues():
+        if src in merged:
+            return None
+    copied = {}
+    for dst, src in _pathcopies(repo, dest, orig).iteritems():
+        if dst in merged:
+            if src not in destmf or destmf.get(src) != basemf.get(src):
+                return None
+            copied[dst] = src
+    def filectxfn(repo, memctx, path):
+        fctx = merged[path]
+        if fctx is None:
+            raise IOError()
+        return lazymemfilectx(fctx, path, copied=copied.get(path))
+    extra = {'rebase_source': orig.hex(),
+             'branch': dest.extra().get('branch', 'default')}
+    new = context.memctx(repo,
+                         parents=[dest.node(), node.nullid],
+                         text=orig.description(),
+                         files=sorted(merged),
+                         filectxfn=filectxfn,
+                         user=orig.user(),
+                         date=orig.date(),
+                         extra=extra)
+    return new, textmerged
+
+def _commitrelocated(repo, relocated):
+    """Commit the result of `_relocatememory`, return the new node or None
+
+    Hooks are run as `localrepo.commit` runs them: precommit first,
+    pretxncommit from `commitctx` and commit once the lock is released.
+    """
+    new, textmerged = relocated
+    for f in textmerged:
+        repo.ui.status(_('merging %s\n') % f)
+    if new is None:
+        return None
+    hookp1 = new.p1().hex()
+    repo.hook('precommit', throw=True, parent1=hookp1, parent2='')
+    ret = repo.commitctx(new)
+    def commithook(node=node.hex(ret), parent1=hookp1, parent2=''):
+        repo.hook('commit', node=node, parent1=parent1, parent2=parent2)
+    repo._afterlock(commithook)
+    return ret
+
+class evolvebatch(object):
+    """Relocate unstable changesets in memory, under a single lock
+
+    Changesets are rebased with `_relocatememory`, each in its own
+    transaction: a failure keeps the changesets already relocated, as
+    solving them one by one does. The working directory is only updated
+    once, when the batch is released. A changeset which can not be
+    relocated in memory must be solved by the regular logic after the batch
+    has been closed.
+    """
+
+    def __init__(self, ui, repo):
+        self.ui = ui
+        self.repo = repo = repo.unfiltered()
+        self.wdnode = None
+        self._copies = {}
+        self._wlock = self._lock = None
+        try:
+            self._wlock = repo.wlock()
+            cmdutil.bailifchanged(repo)
+            self._lock = repo.lock()
+        except:
+            self.release()
+            raise
+
+    def wdp(self):
+        """Working directory parent, as it will be once the batch closes"""
+        if self.wdnode is None:
+            return self.repo['.']
+        return self.repo[self.wdnode]
+
+    def solve(self, orig, progresscb=None):
+        """Relocate unstable <orig>, return False if it must be done with
+        the working directory"""
+        repo = self.repo
+        orig = repo[orig.rev()]
+        # troubles() would compute the bumped and divergent sets as well
+        if (not orig.unstable()
+            or orig.p2().rev() != node.nullrev
+            or not orig.p1().obsolete()):
+            return False
+        try:
+            target = _unstabletarget(self.ui, repo, orig)
+        except util.Abort:
+            return False
+        if orig.rev() == target.rev():
+            return False
+        tr = repo.transaction('evolve')
+        try:
+            # copies only depend on the changesets they are traced between,
+            # those of previous transactions of the batch are still valid
+            tr._evolvecopies = self._copies
+            relocated = _relocatememory(repo, orig, target)
+            if relocated is None:
+                return False
+            _showmove(self.ui, repo, orig, target)
+            if progresscb: progresscb()
+            repo.ui.note('hg rebase -r %s -d %s\n' % (orig, target))
+            destbookmarks = repo.nodebookmarks(target.node())
+            destphase = orig.phase()
+            nodenew = _commitrelocated(repo, relocated)
+            if _relocatemarkers(repo, orig.node(), destphase, target, nodenew,
+                                destbookmarks):
+                _writebookmarks(repo)
+            tr.close()
+        finally:
+            tr.release()
+        if nodenew is None:
+            self.wdnode = target.node()
+        else:
+            self.wdnode = nodenew
+        return True
+
+    def close(self):
+        """Update the working directory and release the batch"""
+        self.release()
+
+    def release(self):
+        """Update the working directory to the last relocated changeset,
+        if any, and release the locks"""
+        try:
+            wdnode, self.wdnode = self.wdnode, None
+            if (wdnode is not None and self._lock is not None
+                and wdnode != self.repo['.'].node()):
+                merge.update(self.repo, wdnode, False, True, False)
+        finally:
+            lockmod.release(self._lock, self._wlock)
+            self._lock = self._wlock = None
+
+def _retractboundary(repo, targetphase, nodes):
+    """Set nodes back to targetphase, like `phases.retractboundary`
+
+    Within a transaction, nodes are collected and retracted when the
+    transaction is closed, with one `phases.retractboundary` call per target
+    phase instead of one per rewritten changeset.
+    """
+    tr = _currenttransaction(repo.unfiltered())
+    if tr is None:
+        phases.retractboundary(repo, targetphase, nodes)
+        return
+    pending = getattr(tr, '_evolvephases', None)
+    if pending is None:
+        pending = tr._evolvephases = {}
+        def retract():
+            for phase in sorted(pending):
+                phases.retractboundary(repo, phase, pending[phase])
+        _ontransactionclose(tr, 'evolve-phases', retract)
+    pending.setdefault(targetphase, []).extend(nodes)
+
+def _writebookmarks(repo):
+    """Write the bookmarks of repo
+
+    Within a transaction, the write is delayed until the transaction is
+    closed: bookmarks updated several times are written once, and not at all
+    if the transaction is aborted.
+    """
+    tr = _currenttransaction(repo.unfiltered())
+    if tr is None:
+        repo._bookmarks.write()
+    else:
+        _ontransactionclose(tr, 'evolve-bookmarks',
+                            lambda: repo._bookmarks.write())
+
+def _pathcopies(repo, x, y):
+    """Return the {dst@y: src@x} copy mapping, like `copies.pathcopies`
+
+    Within a transaction, copies from an ancestor to a descendant are cached.
+    When those to the parent of the descendant are known, only copies
+    introduced by the descendant are traced and chained to them, unless
+    direct tracing could give another result (see `_chaincopies`):
+    rewriting a stack walks the history from its common ancestor once.
+    """
+    tr = _currenttransaction(repo.unfiltered())
+    if (tr is None or x == y or not x or not y
+        or x.rev() is None or y.rev() is None):
+        return copies.pathcopies(x, y)
+    cache = getattr(tr, '_evolvecopies', None)
+    if cache is None:
+        cache = tr._evolvecopies = {}
+    a = y.ancestor(x)
+    if a == x:
+        return dict(_forwardcopies(cache, x, y))
+    if a == y:
+        return _backwardrenames(cache, x, y)
+    return copies._chain(x, y, _backwardrenames(cache, x, a),
+                         _forwardcopies(cache, a, y))
+
+def _forwardcopies(cache, a, b):
+    """{dst@b: src@a} copy mapping where a is an ancestor of b, cached by
+    (a, b) in <cache>. The returned dict must not be modified."""
+    key = (a.node(), b.node())
+    entry = cache.get(key)
+    if entry is not None:
+        _profiler.count('copies.hit')
+        return entry[0]
+    _profiler.count('copies.miss')
+    parents = b.parents()
+    entry = None
+    if len(parents) == 1 and parents[0] != a:
+        known = cache.get((key[0], parents[0].node()))
+        if known is not None:
+            entry = _chaincopies(a, parents[0], b, *known)
+    if entry is None:
+        limit = copies._findlimit(a._repo, a.rev(), b.rev())
+        if limit is None:
+            limit = -1
+        entry = (copies._forwardcopies(a, b), limit)
+    cache[key] = entry
+    return entry[0]
+
+def _chaincopies(a, p, b, known, limit):
+    """Chain <known> copies from <a> to <p>, the parent of <b>, with the
+    copies introduced by <b>
+
+    Return a (copies, limit) entry for <a> and <b>, or None if tracing them
+    directly could give another result. Direct tracing follows the filelog
+    ancestors of each file of <b> until one is found in <a>, giving up on an
+    ancestor linked to a revision lower than <limit>, which is the same for
+    <a> and <p> as for <a> and <b>. Chaining is not possible for a file of
+    <b> with other ancestors than its source in <p> (copied over an existing
+    file or from a file changed since <a>), or if that source is linked to a
+    revision lower than <limit>.
+    """
+    am, pm, bm = a.manifest(), p.manifest(), b.manifest()
+    step = copies._forwardcopies(p, b)
+    for f in b.files():
+        if f not in bm:
+            continue
+        if b[f].renamed():
+            if f in pm or f not in step:
+                return None
+        elif f in known and p[f].linkrev() < limit:
+            return None
+    # like direct tracing, only keep files of b missing from a
+    copied = dict((k, v) for k, v in known.iteritems() if k in bm)
+    for k, v in step.iteritems():
+        if k in am:
+            continue
+        if v in known:
+            if p[v].linkrev() < limit:
+                return None
+            copied[k] = known[v]
+        elif v in am:
+            if am[v] != pm[v]:
+                return None
+            copied[k] = v
+    return copied, limit
+
+def _backwardrenames(cache, a, b):
+    """`copies._backwardrenames` using forward copies cached in <cache>"""
+    r = {}
+    for k, v in sorted(_forwardcopies(cache, b, a).iteritems()):
+        # remove copies
+        if v in a:
+            continue
+        r[v] = k
+    return r
+
 def _bookmarksupdater(repo, oldid):
     """Return a callable update(newid) updating the current bookmark
     and bookmarks bound to oldid to newid.
@@ -809,7 +2493,7 @@ def _bookmarksupdater(repo, oldid):
                 repo._bookmarks[b] = newid
             dirty = True
         if dirty:
-            repo._bookmarks.write()
+            _writebookmarks(repo)
     return updatebookmarks
 
 ### new command
@@ -864,10 +2548,14 @@ def evolve(ui, repo, **opts):
             raise util.Abort('can not specify both "--any" and "--continue"')
         if allopt:
             raise util.Abort('can not specify both "--all" and "--continue"')
-        graftcmd = commands.table['graft'][0]
+        graftcmd = cmdutil.findcmd('graft', commands.table)[1][0]
         return graftcmd(ui, repo, old_obsolete=True, **{'continue': True})
 
-    tr = _picknexttroubled(ui, repo, anyopt or allopt)
+    # building the queue only pays off when solving more than one changeset
+    queue = None
+    if allopt:
+        queue = troubledqueue(repo)
+    tr = _picknexttroubled(ui, repo, anyopt or allopt, queue=queue)
     if tr is None:
         if repo['.'].obsolete():
             displayer = cmdutil.show_changeset(ui, repo, {'template': shorttemplate})
@@ -919,15 +2607,36 @@ def evolve(ui, repo, **opts):
     seen = 1
     count = allopt and _counttroubled(ui, repo) or 1
 
-    while tr is not None:
-        progresscb()
-        result = _evolveany(ui, repo, tr, dryrunopt, progresscb=progresscb)
-        progresscb()
-        seen += 1
-        if not allopt:
-            return result
-        progresscb()
-        tr = _picknexttroubled(ui, repo, anyopt or allopt)
+    # with --all, unstable changesets are relocated in memory as long as
+    # possible and the working directory is only updated at the end
+    batch = None
+    try:
+        while tr is not None:
+            progresscb()
+            if allopt and not dryrunopt and batch is None:
+                batch = evolvebatch(ui, repo)
+            if batch is not None and batch.solve(tr, progresscb):
+                result = 0
+            else:
+                if batch is not None:
+                    batch.close()
+                    batch = None
+                result = _evolveany(ui, repo, tr, dryrunopt,
+                                    progresscb=progresscb)
+            progresscb()
+            seen += 1
+            if not allopt:
+                return result
+            progresscb()
+            wdp = batch is not None and batch.wdp() or None
+            tr = _picknexttroubled(ui, repo, anyopt or allopt, wdp=wdp,
+                                   queue=queue)
+        if batch is not None:
+            batch.close()
+            batch = None
+    finally:
+        if batch is not None:
+            batch.release()
 
     if allopt:
         ui.progress('evolve', None)
@@ -951,55 +2660,196 @@ def _evolveany(ui, repo, tr, dryrunopt, progresscb):
 
 def _counttroubled(ui, repo):
     """Count the amount of troubled changesets"""
-    troubled = set()
-    troubled.update(getrevs(repo, 'unstable'))
-    troubled.update(getrevs(repo, 'bumped'))
-    troubled.update(getrevs(repo, 'divergent'))
-    return len(troubled)
-
-def _picknexttroubled(ui, repo, pickany=False, progresscb=None):
-    """Pick a the next trouble changeset to solve"""
+    return _troubledcounts(repo.unfiltered())[3]
+
+class troubledqueue(object):
+    """Troubled revisions waiting to be solved, by kind and revision order
+
+    Built once per `hg evolve --all` invocation. Sets of obsolete and
+    troubled revisions are computed once too, then kept up to date by
+    `update`, which only evaluates revisions whose troubles may have changed
+    with the changesets and markers created since its previous call:
+
+    - new revisions,
+    - precursors of new markers, and descendants of those becoming
+      obsolete without being unstable before,
+    - successors of the precursors of new markers (and of their own
+      precursors), divergence and bumping depending on them.
+
+    Checking the top of a queue is then a set lookup and picking a revision
+    is O(log n).
+    """
+
+    kinds = ('unstable', 'bumped', 'divergent')
+
+    def __init__(self, repo):
+        self.repo = repo = repo.unfiltered()
+        self._queues = {}
+        self._queued = {}
+        self.troubled = {}
+        for kind in self.kinds:
+            troubled = set(getrevs(repo, kind))
+            queue = list(troubled)
+            heapq.heapify(queue)
+            self._queues[kind] = queue
+            self._queued[kind] = set(queue)
+            self.troubled[kind] = troubled
+        self.obsolete = set(getrevs(repo, 'obsolete'))
+        self._len = len(repo)
+        self._nbmarkers = len(repo.obsstore._all)
+
+    def update(self):
+        """Update troubles with changes made since the last call"""
+        repo = self.repo
+        store = repo.obsstore
+        if len(repo) < self._len or len(store._all) < self._nbmarkers:
+            # history was stripped
+            self.__init__(repo)
+            return
+        markers = store._all[self._nbmarkers:]
+        if not markers and self._len == len(repo):
+            return
+        cl = repo.changelog
+        torev = cl.nodemap.get
+        phase = repo._phasecache.phase
+        obs = self.obsolete
+        unstable = self.troubled['unstable']
+        newrevs = range(self._len, len(repo))
+        changed = set(newrevs)
+        # newly obsolete revisions are not troubled anymore
+        cleared = []
+        precs = set()
+        for mark in markers:
+            precs.add(mark[0])
+            rev = torev(mark[0])
+            if rev is not None and phase(repo, rev) and rev not in obs:
+                obs.add(rev)
+                if rev not in unstable:
+                    cleared.append(rev)
+                for troubled in self.troubled.itervalues():
+                    troubled.discard(rev)
+        # unstable: descendants of obsolete revisions
+        if cleared:
+            changed.update(cl.descendants(cleared))
+        for rev in sorted(changed):
+            if rev in obs or rev in unstable:
+                continue
+            for p in cl.parentrevs(rev):
+                if p in obs or p in unstable:
+                    unstable.add(rev)
+                    break
+        # bumped and divergent: successors of anything the new markers
+        # made a precursor, directly or not
+        related = set(obsolete.allsuccessors(
+            store, obsolete.allprecursors(store, precs)))
+        changed.update(r for r in map(torev, related) if r is not None)
+        newermap = {}
+        for rev in changed:
+            if rev in obs or not phase(repo, rev):
+                continue
+            for kind, check in (('bumped', _isbumped),
+                                ('divergent', _isdivergent)):
+                if check(repo, rev, newermap):
+                    self.troubled[kind].add(rev)
+                else:
+                    self.troubled[kind].discard(rev)
+        for kind in self.kinds:
+            troubled = self.troubled[kind]
+            queue, queued = self._queues[kind], self._queued[kind]
+            for rev in changed:
+                if rev in troubled and rev not in queued:
+                    heapq.heappush(queue, rev)
+                    queued.add(rev)
+        self._len = len(repo)
+        self._nbmarkers = len(store._all)
+
+    def first(self):
+        """Return the first unstable, bumped or divergent revision, or None
+        """
+        for kind in self.kinds:
+            troubled = self.troubled[kind]
+            queue, queued = self._queues[kind], self._queued[kind]
+            while queue:
+                if queue[0] in troubled:
+                    return queue[0]
+                queued.discard(heapq.heappop(queue))
+        return None
+
+def _picknexttroubled(ui, repo, pickany=False, progresscb=None, wdp=None,
+                      queue=None):
+    """Pick a the next trouble changeset to solve
+
+    <wdp> replaces the working directory parent when provided. <queue> is
+    the `troubledqueue` of the current evolve invocation, if any."""
     if progresscb: progresscb()
-    tr = _stabilizableunstable(repo, repo['.'])
-    if tr is None:
+    if wdp is None:
         wdp = repo['.']
-        if 'divergent' in wdp.troubles():
+    if queue is None:
+        unstable = divergent = None
+    else:
+        queue.update()
+        unstable = queue.troubled['unstable']
+        divergent = queue.troubled['divergent']
+    tr = _stabilizableunstable(repo, wdp, unstable)
+    if tr is None:
+        if divergent is None:
+            divergent = getrevs(repo, 'divergent')
+        if wdp.rev() in divergent:
             tr = wdp
     if tr is None and pickany:
-        troubled = list(repo.set('unstable()'))
-        if not troubled:
-            troubled = list(repo.set('bumped()'))
-        if not troubled:
-            troubled = list(repo.set('divergent()'))
-        if troubled:
-            tr = troubled[0]
+        if queue is None:
+            queue = troubledqueue(repo)
+        rev = queue.first()
+        if rev is not None:
+            tr = repo[rev]
 
     return tr
 
-def _stabilizableunstable(repo, pctx):
+def _stabilizableunstable(repo, pctx, unstable=None):
     """Return a changectx for an unstable changeset which can be
     stabilized on top of pctx or one of its descendants. None if none
     can be found.
+
+    <unstable> is the set of unstable revisions, when already known.
+
+    Candidates are looked for as children of pctx, of its precursors, then
+    of each descendant of pctx followed by its precursors. Instead of
+    walking them, unstable changesets are mapped from their parents and
+    each parent is ranked by its first position in that sequence.
     """
-    def selfanddescendants(repo, pctx):
-        yield pctx
-        for prec in repo.set('allprecursors(%d)', pctx):
-            yield prec
-        for ctx in pctx.descendants():
-            yield ctx
-            for prec in repo.set('allprecursors(%d)', ctx):
-                yield prec
-
-    # Look for an unstable which can be stabilized as a child of
-    # node. The unstable must be a child of one of node predecessors.
-    for ctx in selfanddescendants(repo, pctx):
-        for child in ctx.children():
-            if child.unstable():
-                return child
-    return None
+    parentrevs = repo.unfiltered().changelog.parentrevs
+    if unstable is None:
+        unstable = getrevs(repo, 'unstable')
+    orphans = {} # parent rev -> smallest unstable child
+    for rev in unstable:
+        for p in parentrevs(rev):
+            if p != node.nullrev and rev < orphans.get(p, rev + 1):
+                orphans[p] = rev
+    if not orphans:
+        return None
+    prev = pctx.rev()
+    heads = set(repo.changelog.descendants([prev]))
+    heads.add(prev)
+    closure = _obsindex(repo).closure
+    best = None
+    for p, child in orphans.iteritems():
+        # a descendant is met first as a precursor of a lower one
+        key = None
+        succs = heads.intersection(closure(p))
+        if succs:
+            key = (min(succs), 1, p, child)
+        if p in heads and (key is None or p <= key[0]):
+            key = (p, 0, p, child)
+        if key is None:
+            continue
+        if best is None or key < best:
+            best = key
+    if best is None:
+        return None
+    return repo[best[3]]
 
-def _solveunstable(ui, repo, orig, dryrun=False, progresscb=None):
-    """Stabilize a unstable changeset"""
+def _unstabletarget(ui, repo, orig):
+    """Return the changeset an unstable changeset should be moved on"""
     obs = orig.parents()[0]
     if not obs.obsolete():
         print obs.rev(), orig.parents()
@@ -1020,15 +2870,21 @@ def _solveunstable(ui, repo, orig, dryrun=False, progresscb=None):
     if len(targets) > 1:
         raise util.Abort(_("does not handle split parents yet\n"))
         return 2
-    target = targets[0]
+    return repo[targets[0]]
+
+def _showmove(ui, repo, orig, target):
     displayer = cmdutil.show_changeset(ui, repo, {'template': shorttemplate})
-    target = repo[target]
     repo.ui.status(_('move:'))
     if not ui.quiet:
         displayer.show(orig)
     repo.ui.status(_('atop:'))
     if not ui.quiet:
         displayer.show(target)
+
+def _solveunstable(ui, repo, orig, dryrun=False, progresscb=None):
+    """Stabilize a unstable changeset"""
+    target = _unstabletarget(ui, repo, orig)
+    _showmove(ui, repo, orig, target)
     if progresscb: progresscb()
     todo = 'hg rebase -r %s -d %s\n' % (orig, target)
     if dryrun:
@@ -1100,7 +2956,7 @@ def _solvebumped(ui, repo, bumped, dryrun=False, progresscb=None):
                 # Create the new commit context
                 repo.ui.status(_('computing new diff\n'))
                 files = set()
-                copied = copies.pathcopies(prec, bumped)
+                copied = _pathcopies(repo, prec, bumped)
                 precmanifest = prec.manifest()
                 for key, val in bumped.manifest().iteritems():
                     if precmanifest.pop(key, None) != val:
@@ -1110,13 +2966,8 @@ def _solvebumped(ui, repo, bumped, dryrun=False, progresscb=None):
                 if files: # something to commit!
                     def filectxfn(repo, ctx, path):
                         if path in bumped:
-                            fctx = bumped[path]
-                            flags = fctx.flags()
-                            mctx = context.memfilectx(fctx.path(), fctx.data(),
-                                                      islink='l' in flags,
-                                                      isexec='x' in flags,
-                                                      copied=copied.get(path))
-                            return mctx
+                            return lazymemfilectx(bumped[path],
+                                                  copied=copied.get(path))
                         raise IOError()
                     text = 'bumped update to %s:\n\n' % prec
                     text += bumped.description()
@@ -1135,7 +2986,7 @@ def _solvebumped(ui, repo, bumped, dryrun=False, progresscb=None):
                     createmarkers(repo, [(tmpctx, ())])
                     newid = prec.node()
                 else:
-                    phases.retractboundary(repo, bumped.phase(), [newid])
+                    _retractboundary(repo, bumped.phase(), [newid])
                     createmarkers(repo, [(tmpctx, (repo[newid],))],
                                            flag=obsolete.bumpedfix)
                 bmupdate(newid)
@@ -1246,7 +3097,7 @@ def _solvedivergent(ui, repo, divergent, dryrun=False, progresscb=None):
             else:
                 new = repo['.']
             createmarkers(repo, [(other, (new,))])
-            phases.retractboundary(repo, other.phase(), [new.node()])
+            _retractboundary(repo, other.phase(), [new.node()])
             tr.close()
         finally:
             tr.release()
@@ -1341,26 +3192,104 @@ def _reachablefrombookmark(repo, revs, mark):
     if mark not in marks:
         raise util.Abort(_("bookmark '%s' not found") % mark)
 
+    cl = repo.changelog
+    markrev = cl.rev(marks[mark])
     # If the requested bookmark is not the only one pointing to a
     # a revision we have to only delete the bookmark and not strip
-    # anything. revsets cannot detect that case.
-    uniquebm = True
+    # anything.
+    unfi = repo.unfiltered().changelog
+    others = set()
     for m, n in marks.iteritems():
-        if m != mark and n == repo[mark].node():
-            uniquebm = False
-            break
-    if uniquebm:
-        rsrevs = repo.revs("ancestors(bookmark(%s)) - "
-                           "ancestors(head() and not bookmark(%s)) - "
-                           "ancestors(bookmark() and not bookmark(%s)) - "
-                           "obsolete()",
-                           mark, mark, mark)
-        revs.update(set(rsrevs))
+        if m == mark:
+            continue
+        r = unfi.rev(n)
+        if r == markrev:
+            return marks, revs
+        if r not in cl.filteredrevs:
+            others.add(r)
+    # like head() in revsets, every visible head of a named branch
+    for heads in repo.branchmap().itervalues():
+        others.update(cl.rev(n) for n in heads)
+    others.discard(markrev)
+    revs.update(_exclusiveancestors(repo, markrev, others))
     return marks,revs
 
-def _deletebookmark(ui, marks, mark):
-    del marks[mark]
-    marks.write()
+def _exclusiveancestors(repo, rev, others):
+    """Non-obsolete ancestors of <rev> which are not ancestors of <others>
+
+    Revisions are their own ancestors. The changelog is walked once, from the
+    highest revision down, stopping as soon as every ancestor of <rev> left to
+    visit is shared with <others>.
+    """
+    cl = repo.changelog
+    parentrevs = cl.parentrevs
+    obsoletes = getrevs(repo, 'obsolete')
+    # 1: ancestor of <rev> only, 2: ancestor of <others>
+    state = dict.fromkeys(others, 2)
+    if rev == node.nullrev or rev in state:
+        return set()
+    state[rev] = 1
+    pending = 1 # ancestors of <rev> only, left to visit
+    exclusive = set()
+    r = max(state)
+    while pending:
+        s = state.get(r)
+        if s == 1:
+            pending -= 1
+            if r not in obsoletes:
+                exclusive.add(r)
+        if s is not None:
+            for p in parentrevs(r):
+                if p == node.nullrev:
+                    continue
+                ps = state.get(p)
+                if ps is None:
+                    state[p] = s
+                    pending += s == 1
+                elif ps == 1 and s == 2:
+                    state[p] = 2
+                    pending -= 1
+        r -= 1
+    return exclusive
+
+def _lastlivingancestors(repo, revs):
+    """Map revisions of <revs> to their highest non-obsolete ancestor
+
+    Revisions are their own ancestors. Those without non-obsolete ancestors
+    are missing from the result. The changelog is walked once, from the
+    highest revision down, stopping when every revision has been mapped.
+    """
+    cl = repo.unfiltered().changelog
+    obsoletes = getrevs(repo, 'obsolete')
+    # rev -> revisions of <revs> looking for a destination through rev
+    seeking = dict((r, set([r])) for r in revs)
+    heap = [-r for r in seeking]
+    heapq.heapify(heap)
+    dests = {}
+    while heap:
+        r = -heapq.heappop(heap)
+        # revisions are visited in decreasing order: the first non-obsolete
+        # ancestor found is the highest one
+        seekers = seeking.pop(r).difference(dests)
+        if not seekers:
+            continue
+        if r not in obsoletes:
+            for s in seekers:
+                dests[s] = r
+            continue
+        for p in cl.parentrevs(r):
+            if p == node.nullrev:
+                continue
+            if p in seeking:
+                seeking[p].update(seekers)
+            else:
+                seeking[p] = set(seekers)
+                heapq.heappush(heap, -p)
+    return dests
+
+def _deletebookmark(ui, repo, mark):
+    del repo._bookmarks[mark]
+    _writebookmarks(repo)
     ui.write(_("bookmark '%s' deleted\n") % mark)
 
 
@@ -1414,30 +3343,30 @@ def cmdprune(ui, repo, *revs, **opts):
         marks,revs = _reachablefrombookmark(repo, revs, bookmark)
         if not revs:
             # no revisions to prune - delete bookmark immediately
-            _deletebookmark(ui, marks, bookmark)
+            _deletebookmark(ui, repo, bookmark)
 
     if not revs:
         raise util.Abort(_('nothing to prune'))
 
     wlock = lock = None
     wlock = repo.wlock()
-    sortedrevs = lambda specs: sorted(set(scmutil.revrange(repo, specs)))
     try:
         lock = repo.lock()
         # defines pruned changesets
-        precs = []
-        for p in sortedrevs(revs):
-            cp = repo[p]
-            if not cp.mutable():
-                # note: createmarkers() would have raised something anyway
-                raise util.Abort('cannot prune immutable changeset: %s' % cp,
-                                 hint='see "hg help phases" for details')
-            precs.append(cp)
+        revs = sorted(revs)
+        immutable = repo.revs('%ld and public()', revs)
+        if immutable:
+            # note: createmarkers() would have raised something anyway
+            raise util.Abort('cannot prune immutable changeset: %s'
+                             % repo[min(immutable)],
+                             hint='see "hg help phases" for details')
+        precs = [repo[p] for p in revs]
         if not precs:
             raise util.Abort('nothing to prune')
 
         # defines successors changesets
-        sucs = tuple(repo[n] for n in sortedrevs(succs))
+        sucs = tuple(repo[n] for n in sorted(set(scmutil.revrange(repo,
+                                                                  succs))))
         if not biject and len(sucs) > 1 and len(precs) > 1:
             msg = "Can't use multiple successors for multiple precursors"
             raise util.Abort(msg)
@@ -1463,15 +3392,24 @@ def cmdprune(ui, repo, *revs, **opts):
         if newnode.node() != wdp.node():
             commands.update(ui, repo, newnode.rev())
             ui.status(_('working directory now at %s\n') % newnode)
-        # update bookmarks
-        if bookmark:
-            _deletebookmark(ui, marks, bookmark)
-        for ctx in repo.unfiltered().set('bookmark() and %ld', precs):
-            ldest = list(repo.set('max((::%d) - obsolete())', ctx))
-            if ldest:
-                dest = ldest[0]
-                updatebookmarks = _bookmarksupdater(repo, ctx.node())
-                updatebookmarks(dest.node())
+        # update bookmarks, written once when closing the transaction
+        cl = repo.unfiltered().changelog
+        bookmarked = lambda: set(cl.rev(n)
+                                 for n in repo._bookmarks.itervalues())
+        if bookmark or bookmarked().intersection(revs):
+            tr = repo.transaction('prune')
+            try:
+                if bookmark:
+                    _deletebookmark(ui, repo, bookmark)
+                moved = bookmarked().intersection(revs)
+                dests = _lastlivingancestors(repo, moved)
+                for r in sorted(moved):
+                    if r in dests:
+                        updatebookmarks = _bookmarksupdater(repo, cl.node(r))
+                        updatebookmarks(cl.node(dests[r]))
+                tr.close()
+            finally:
+                tr.release()
     finally:
         lockmod.release(lock, wlock)
 
@@ -1522,19 +3460,13 @@ def _commitfiltered(repo, ctx, match):
         return None
 
     # Filter copies
-    copied = copies.pathcopies(base, ctx)
+    copied = _pathcopies(repo, base, ctx)
     copied = dict((src, dst) for src, dst in copied.iteritems()
                   if dst in files)
     def filectxfn(repo, memctx, path):
         if path not in ctx:
             raise IOError()
-        fctx = ctx[path]
-        flags = fctx.flags()
-        mctx = context.memfilectx(fctx.path(), fctx.data(),
-                                  islink='l' in flags,
-                                  isexec='x' in flags,
-                                  copied=copied.get(path))
-        return mctx
+        return lazymemfilectx(ctx[path], copied=copied.get(path))
 
     new = context.memctx(repo,
                          parents=[base.node(), node.nullid],
@@ -1635,7 +3567,7 @@ def uncommit(ui, repo, *pats, **opts):
                 raise util.Abort(_('nothing to uncommit'))
             # Move local changes on filtered changeset
             createmarkers(repo, [(old, (repo[newid],))])
-            phases.retractboundary(repo, oldphase, [newid])
+            _retractboundary(repo, oldphase, [newid])
             repo.dirstate.setparents(newid, node.nullid)
             _uncommitdirstate(repo, old, match)
             updatebookmarks(newid)
@@ -1648,6 +3580,7 @@ def uncommit(ui, repo, *pats, **opts):
         lock.release()
 
 @eh.wrapcommand('commit')
+@_profiled('commitwrapper')
 def commitwrapper(orig, ui, repo, *arg, **kwargs):
     if kwargs.get('amend', False):
         lock = None
@@ -1670,7 +3603,7 @@ def commitwrapper(orig, ui, repo, *arg, **kwargs):
             for book in oldbookmarks:
                 repo._bookmarks[book] = new.node()
             if oldbookmarks:
-                repo._bookmarks.write()
+                _writebookmarks(repo)
         return result
     finally:
         if lock is not None:
@@ -1702,9 +3635,11 @@ def touch(ui, repo, *revs, **opts):
     try:
         wlock = repo.wlock()
         lock = repo.lock()
+        # phases and bookmarks are written once, when closing it
         tr = repo.transaction('touch')
         revs.sort() # ensure parent are run first
         newmapping = {}
+        relations = []
         try:
             for r in revs:
                 ctx = repo[r]
@@ -1720,11 +3655,15 @@ def touch(ui, repo, *revs, **opts):
                                  commitopts={'extra': extra})
                 # store touched version to help potential children
                 newmapping[ctx.node()] = new
-                if not duplicate:
-                    createmarkers(repo, [(ctx, (repo[new],))])
-                phases.retractboundary(repo, ctx.phase(), [new])
-                if ctx in repo[None].parents():
-                    repo.dirstate.setparents(new, node.nullid)
+                relations.append((ctx, (repo[new],)))
+                _retractboundary(repo, ctx.phase(), [new])
+            # markers are only created once every changeset is rewritten
+            if not duplicate:
+                createmarkers(repo, relations)
+            wdparents = repo.dirstate.parents()
+            newparents = [newmapping.get(p, p) for p in wdparents]
+            if newparents != list(wdparents):
+                repo.dirstate.setparents(*newparents)
             tr.close()
         finally:
             tr.release()
@@ -1785,7 +3724,7 @@ def fold(ui, repo, *revs, **opts):
             newid, _ = rewrite(repo, root, allctx, head,
                              [root.p1().node(), root.p2().node()],
                              commitopts=commitopts)
-            phases.retractboundary(repo, targetphase, [newid])
+            _retractboundary(repo, targetphase, [newid])
             createmarkers(repo, [(ctx, (repo[newid],))
                                  for ctx in allctx])
             tr.close()
@@ -1797,8 +3736,126 @@ def fold(ui, repo, *revs, **opts):
     finally:
         lockmod.release(lock, wlock)
 
+def _relevantmarkers(repo, markers):
+    """Return the markers of <markers> worth keeping in <repo>
+
+    Markers are grouped by the connected parts of the obsolescence graph
+    they belong to. Parts without any changeset known locally are dropped,
+    as well as markers repeating the relation of a previous one."""
+    groups = {}
+    def find(n):
+        root = n
+        while groups.get(root, root) != root:
+            root = groups[root]
+        while n != root:
+            groups[n], n = root, groups[n]
+        return root
+    for prec, sucs, flags, metadata in markers:
+        root = find(prec)
+        for suc in sucs:
+            other = find(suc)
+            if other != root:
+                groups[other] = root
+        groups.setdefault(prec, root)
+    nodemap = repo.changelog.nodemap
+    known = set(find(n) for n in groups if n in nodemap)
+    seen = set()
+    relevant = []
+    for mark in markers:
+        relation = mark[:3]
+        if relation in seen or find(mark[0]) not in known:
+            continue
+        seen.add(relation)
+        relevant.append(mark)
+    return relevant
+
+def _timedread(repo, data):
+    """Return the markers encoded in <data>, the content of the obsstore of
+    <repo>, and the time spent parsing them"""
+    start = time.time()
+    validated, repaired = markerrepair.read(repo.opener, data)
+    markers = compactmarkers()
+    markers.load(markerreader(data, validated, repaired))
+    return markers, time.time() - start
+
+@command('debugobsstorecompact', [], '')
+def debugobsstorecompact(ui, repo):
+    """rewrite the obsstore with the markers relevant to this repository
+
+    Markers only relating changesets unknown to this repository, directly
+    or through other markers, are dropped. So are markers repeating the
+    precursor, successors and flags of a previous one. Dropped markers are
+    not exchanged anymore.
+
+    Markers are never dropped for being superseded by later ones: a later
+    marker for the same precursor records divergence, which would go
+    unnoticed without the earlier one, and markers of a chain are all
+    needed by repositories holding its intermediate changesets.
+    """
+    repo = repo.unfiltered()
+    lock = repo.lock()
+    try:
+        data = repo.sopener.tryread('obsstore')
+        if not data:
+            ui.status(_('no obsolescence markers\n'))
+            return 0
+        markers, oldtime = _timedread(repo, data)
+        relevant = _relevantmarkers(repo, list(markers))
+        if len(relevant) == len(markers):
+            ui.status(_('obsstore is already compact\n'))
+            return 0
+        tr = repo.transaction('obsstore-compact')
+        backup = None
+        closed = False
+        try:
+            if util.safehasattr(tr, 'addbackup'):
+                tr.addbackup('obsstore')
+            else:
+                # transactions older than Mercurial 3.0 cannot back files up
+                backup = repo.sjoin('obsstore.compact-backup')
+                util.copyfile(repo.sjoin('obsstore'), backup)
+            f = repo.sopener('obsstore', 'w', atomictemp=True)
+            for chunk in obsolete._encodemarkers(relevant, True):
+                f.write(chunk)
+            f.close()
+            tr.close()
+            closed = True
+        finally:
+            tr.release()
+            if backup is not None:
+                if closed:
+                    util.unlink(backup)
+                else:
+                    util.rename(backup, repo.sjoin('obsstore'))
+        # caches of evolve are keyed on the previous content
+        for name in (obsindex._filename, troubledcache._filename,
+                     markerrepair._filename):
+            try:
+                util.unlink(repo.join(name))
+            except OSError:
+                pass
+        repo.invalidate()
+        newdata = repo.sopener.read('obsstore')
+        newmarkers, newtime = _timedread(repo, newdata)
+        ui.write(_('markers: %i -> %i\n') % (len(markers), len(newmarkers)))
+        ui.write(_('size: %i -> %i bytes\n') % (len(data), len(newdata)))
+        ui.write(_('parse time: %.4f -> %.4f seconds\n')
+                 % (oldtime, newtime))
+    finally:
+        lock.release()
 
 
+@command('debugevolvesetup', [], '')
+def debugevolvesetup(ui, repo):
+    """display what evolve installed in this process
+
+    Command wrappers are installed when their command is first run. In a
+    long running process, other counts must not grow except for
+    repositories.
+    """
+    for name, count in sorted(eh.installed.iteritems()):
+        ui.write('%s: %i\n' % (name, count))
+
 @eh.wrapcommand('graft')
 def graftwrapper(orig, ui, repo, *revs, **kwargs):
     kwargs = dict(kwargs)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+#
+# run-benchmarks.py - time evolve commands on synthetic repositories
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+"""Time evolve commands on a synthetic repository
+
+A repository is generated with:
+
+- a linear history of --changesets changesets,
+- --markers obsolescence markers between random unknown nodes,
+- a stack of --stack-depth unstable changesets, left by amending the
+  changeset below them,
+- --divergence successors of a side changeset, each amending it with a
+  different new file.
+
+Every benchmark runs --repeat times, on a fresh copy of this repository.
+Results are written as JSON to --output so that runs against different
+versions can be compared.
+"""
+
+import json
+import optparse
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+# name, command line; %(tip)s, %(top)s and %(stack)s are replaced by revisions
+# of the generated repository
+benchmarks = [
+    # startup cost of the extension
+    ('version', ['version']),
+    ('status', ['status']),
+    ('evolve-all', ['evolve', '--all']),
+    ('prune', ['prune', '-r', '%(top)s']),
+    ('fold', ['fold', '-r', '%(stack)s::%(top)s']),
+    ('touch', ['touch', '-r', '%(top)s']),
+    ('olog', ['olog']),
+    ('allsuccessors', ['log', '--hidden', '-r', 'allsuccessors(all())',
+                       '--template', '{rev}\n']),
+    ('summary', ['summary']),
+    # a single marker added to --markers existing ones
+    ('create-marker', ['debugobsolete', 'a' * 40, 'b' * 40]),
+]
+
+def parseargs():
+    parser = optparse.OptionParser('%prog [options] [benchmark ...]')
+    parser.add_option('--with-hg', default='hg',
+        help='hg executable to benchmark (default: hg)')
+    parser.add_option('--evolve',
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'hgext', 'evolve.py'),
+        help='path of the evolve extension')
+    parser.add_option('-n', '--changesets', type='int', default=500,
+        help='number of changesets of the linear history (default: 500)')
+    parser.add_option('-m', '--markers', type='int', default=10000,
+        help='number of unrelated markers (default: 10000)')
+    parser.add_option('-d', '--stack-depth', type='int', default=20,
+        help='number of unstable changesets (default: 20)')
+    parser.add_option('-k', '--divergence', type='int', default=2,
+        help='number of divergent successors (default: 2); evolve --all '
+             'cannot solve more than 2')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+        help='runs of every benchmark (default: 3)')
+    parser.add_option('-o', '--output', default='benchmarks.json',
+        help='file to write results to (default: benchmarks.json)')
+    parser.add_option('--seed', type='int', default=0,
+        help='seed of the random generator (default: 0)')
+    parser.add_option('--tmpdir',
+        help='directory to generate repositories in')
+    parser.add_option('--keep-tmpdir', action='store_true',
+        help='do not remove the generated repositories')
+    options, args = parser.parse_args()
+    if options.stack_depth < 1:
+        parser.error('--stack-depth must be at least 1')
+    if options.changesets <= options.stack_depth + 1:
+        parser.error('--changesets must be greater than --stack-depth + 1')
+    known = [name for name, cmd in benchmarks]
+    for name in args:
+        if name not in known:
+            parser.error('unknown benchmark %s (one of %s)'
+                         % (name, ', '.join(known)))
+    return options, args
+
+class runner(object):
+    """Run hg with evolve enabled and an isolated configuration"""
+
+    def __init__(self, options, tmpdir):
+        self.hg = options.with_hg
+        hgrc = os.path.join(tmpdir, 'hgrc')
+        f = open(hgrc, 'w')
+        try:
+            f.write('[ui]\nusername = bench\n'
+                    '[phases]\npublish = False\n'
+                    '[extensions]\nrebase =\nevolve = %s\n'
+                    % os.path.abspath(options.evolve))
+        finally:
+            f.close()
+        self.env = dict(os.environ)
+        self.env.update({'HGRCPATH': hgrc, 'HGPLAIN': '1',
+                         'HGENCODING': 'ascii', 'LANG': 'C',
+                         'TZ': 'GMT',
+                         # fold always edits the commit message
+                         'HGEDITOR': 'sh -c \'echo benchmark > "$0"\''})
+
+    def __call__(self, repo, args, check=True):
+        """Run hg in <repo>, return its exit code and wall time"""
+        devnull = open(os.devnull, 'w')
+        try:
+            start = time.time()
+            code = subprocess.call([self.hg] + args, cwd=repo, env=self.env,
+                                   stdin=devnull, stdout=devnull,
+                                   stderr=devnull)
+            elapsed = time.time() - start
+        finally:
+            devnull.close()
+        if check and code:
+            raise SystemExit('hg %s failed in %s (exit code %i)'
+                             % (' '.join(args), repo, code))
+        return code, elapsed
+
+    def output(self, repo, args):
+        """Run hg in <repo>, return its standard output"""
+        proc = subprocess.Popen([self.hg] + args, cwd=repo, env=self.env,
+                                stdout=subprocess.PIPE)
+        out = proc.communicate()[0]
+        if proc.returncode:
+            raise SystemExit('hg %s failed in %s (exit code %i)'
+                             % (' '.join(args), repo, proc.returncode))
+        return out
+
+def writefile(path, data):
+    f = open(path, 'a')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+def writemarkers(repo, count, rng):
+    """Append <count> markers between random nodes to the obsstore"""
+    path = os.path.join(repo, '.hg', 'store', 'obsstore')
+    header = not os.path.exists(path) or not os.path.getsize(path)
+    metadata = 'date:0 0\0user:bench'
+    f = open(path, 'ab')
+    try:
+        if header:
+            f.write(struct.pack('>B', 0))
+        for i in xrange(count):
+            prec = ''.join(chr(rng.randrange(256)) for j in xrange(20))
+            sucs = [''.join(chr(rng.randrange(256)) for j in xrange(20))
+                    for s in xrange(rng.choice((0, 1, 1, 1, 2)))]
+            f.write(struct.pack('>BIB20s', len(sucs), len(metadata), 0, prec))
+            f.write(''.join(sucs))
+            f.write(metadata)
+    finally:
+        f.close()
+
+def generate(hg, options, path):
+    """Create the benchmark repository at <path>, return revisions to use
+    in benchmark command lines"""
+    rng = random.Random(options.seed)
+    os.mkdir(path)
+    hg(path, ['init'])
+    hg(path, ['debugbuilddag', '--new-file', '+%i' % options.changesets])
+    writemarkers(path, options.markers, rng)
+    # divergent successors of a side head, away from the unstable stack so
+    # that evolve --all has a single destination
+    hg(path, ['update', '-r', '0'])
+    writefile(os.path.join(path, 'side'), 'side\n')
+    hg(path, ['commit', '-A', '-m', 'side'])
+    side = str(options.changesets)
+    for i in xrange(options.divergence):
+        hg(path, ['update', '--hidden', '-r', side])
+        writefile(os.path.join(path, 'side%i' % i), 'side\n')
+        hg(path, ['amend', '-A'])
+    # amend the changeset below the stack
+    top = options.changesets - 1
+    base = top - options.stack_depth
+    hg(path, ['update', '-r', str(base)])
+    writefile(os.path.join(path, 'nf%i' % base), 'amended\n')
+    hg(path, ['amend', '-m', 'amended'])
+    tip = hg.output(path, ['log', '-r', '.', '--template', '{rev}']).strip()
+    return {'tip': tip, 'top': str(top), 'stack': str(base + 1)}
+
+def hgversion(hg):
+    try:
+        return hg.output(None, ['--version', '--quiet']).strip()
+    except OSError:
+        raise SystemExit('cannot run %s' % hg.hg)
+
+def main():
+    options, names = parseargs()
+    tmpdir = tempfile.mkdtemp(prefix='evolvebench', dir=options.tmpdir)
+    try:
+        hg = runner(options, tmpdir)
+        version = hgversion(hg)
+        template = os.path.join(tmpdir, 'template')
+        print 'generating repository in %s' % template
+        start = time.time()
+        revs = generate(hg, options, template)
+        print 'generated in %.2f seconds' % (time.time() - start)
+        results = {}
+        for name, cmd in benchmarks:
+            if names and name not in names:
+                continue
+            args = [a % revs for a in cmd]
+            runs = []
+            codes = set()
+            for i in xrange(options.repeat):
+                repo = os.path.join(tmpdir, '%s-%i' % (name, i))
+                shutil.copytree(template, repo, symlinks=True)
+                code, elapsed = hg(repo, args, check=False)
+                codes.add(code)
+                runs.append(elapsed)
+                shutil.rmtree(repo)
+            runs.sort()
+            results[name] = {'command': ['hg'] + args,
+                             'runs': runs,
+                             'min': runs[0],
+                             'median': runs[len(runs) // 2],
+                             'exitcodes': sorted(codes)}
+            print '%-16s min %8.3fs  median %8.3fs' % (name, runs[0],
+                                                      runs[len(runs) // 2])
+        data = {'hg': version,
+                'evolve': os.path.abspath(options.evolve),
+                'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'parameters': {'changesets': options.changesets,
+                               'markers': options.markers,
+                               'stack-depth': options.stack_depth,
+                               'divergence': options.divergence,
+                               'repeat': options.repeat,
+                               'seed': options.seed},
+                'results': results}
+        f = open(options.output, 'w')
+        try:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.write('\n')
+        finally:
+            f.close()
+        print 'results written to %s' % options.output
+    finally:
+        if options.keep_tmpdir:
+            print 'keeping %s' % tmpdir
+        else:
+            shutil.rmtree(tmpdir, True)
+
+if __name__ == '__main__':
+    sys.exit(main())
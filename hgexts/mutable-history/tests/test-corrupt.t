@@ -120,3 +120,29 @@
 
 
 
+
+Markers with nullid successors, created by older versions, are repaired on read
+
+  $ cd ..
+  $ hg init repair
+  $ cd repair
+  $ hg debugobsolete aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb -d '0 0'
+  $ python -c "import struct; open('.hg/store/obsstore', 'ab').write(struct.pack('>BIB20s', 1, 0, 0, '\x11' * 20) + '\0' * 20)"
+  $ hg debugobsolete
+  repo contains 1 invalid obsolescence markers
+  aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb 0 {'date': '0 0', 'user': 'test'}
+  1111111111111111111111111111111111111111 0 {}
+
+The check is recorded and only runs on markers appended afterward
+
+  $ ls .hg/cache | grep evolve
+  evolve-obsrepair
+  $ hg debugobsolete | tail -1
+  1111111111111111111111111111111111111111 0 {}
+  $ python -c "import struct; open('.hg/store/obsstore', 'ab').write(struct.pack('>BIB20s', 2, 0, 0, '\x22' * 20) + '\x33' * 20 + '\0' * 20)"
+  $ hg debugobsolete | tail -2
+  repo contains 2 invalid obsolescence markers
+  1111111111111111111111111111111111111111 0 {}
+  2222222222222222222222222222222222222222 3333333333333333333333333333333333333333 0 {}
+  $ hg debugobsolete | tail -1
+  2222222222222222222222222222222222222222 3333333333333333333333333333333333333333 0 {}
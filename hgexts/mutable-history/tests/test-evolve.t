@@ -675,3 +675,226 @@ Test evolving renames
   A c
     a
   R a
+
+Copies of a stack are traced once from its common ancestor
+
+  $ cd $TESTTMP
+  $ hg init copies
+  $ cd copies
+  $ mkcommit a
+  $ mkcommit b
+  $ hg mv a c
+  $ hg ci -m c
+  $ hg mv c d
+  $ hg ci -m d
+  $ mkcommit e
+  $ hg up -q 1
+  $ echo b2 > b
+  $ hg amend -q
+  3 new unstable changesets
+  $ hg evolve --all -q --config evolve.profile=yes 2>&1 | grep copies
+    copies.hit                    5
+    copies.miss                   7
+  $ hg log -G --template '{rev} {desc} {file_copies}\n'
+  @  9 add e
+  |
+  o  8 d d (c)
+  |
+  o  7 c c (a)
+  |
+  o  6 add b
+  |
+  o  0 add a
+  
+
+Cached copies are the ones traced directly: renamed then removed, copied over
+an existing file, or copied from a changed file
+
+  $ cat > $TESTTMP/copiescheck.py <<EOF
+  > from mercurial import cmdutil, copies, extensions
+  > cmdtable = {}
+  > command = cmdutil.command(cmdtable)
+  > @command('debugcopiescheck', [], '')
+  > def debugcopiescheck(ui, repo):
+  >     evolve = extensions.find('evolve')
+  >     lock = repo.lock()
+  >     try:
+  >         tr = repo.transaction('check')
+  >         try:
+  >             for y in repo:
+  >                 for x in repo:
+  >                     x, y = repo[x], repo[y]
+  >                     core = copies.pathcopies(x, y)
+  >                     cached = evolve._pathcopies(repo, x, y)
+  >                     if core != cached:
+  >                         ui.write('%s -> %s: %r != %r\n'
+  >                                  % (x, y, core, cached))
+  >             tr.close()
+  >         finally:
+  >             tr.release()
+  >     finally:
+  >         lock.release()
+  > EOF
+  $ hg init $TESTTMP/copycheck
+  $ cd $TESTTMP/copycheck
+  $ echo x > x
+  $ echo y > y
+  $ echo a > a
+  $ hg ci -qAm base
+  $ hg mv a c
+  $ hg ci -m 'rename a'
+  $ hg rm c
+  $ hg ci -m 'remove c'
+  $ hg cp -f x y
+  $ hg ci -m 'copy x over y'
+  $ hg mv y z
+  $ hg ci -m 'rename y'
+  $ echo x2 >> x
+  $ hg ci -m 'change x'
+  $ hg cp x w
+  $ hg mv x v
+  $ hg ci -m 'copy and rename x'
+  $ hg log --template '{rev} {file_copies}\n'
+  6 v (x)w (x)
+  5 
+  4 z (y)
+  3 y (x)
+  2 
+  1 c (a)
+  0 
+  $ hg debugcopiescheck --config extensions.copiescheck=$TESTTMP/copiescheck.py
+
+Files merged on both sides by several workers can be larger than the pipe
+buffer
+
+  $ cd $TESTTMP
+  $ hg init bigmerge
+  $ cd bigmerge
+  $ cat > edit.py <<EOF
+  > import sys
+  > line, text = int(sys.argv[1]), sys.argv[2]
+  > for i in range(40):
+  >     f = 'f%02d' % i
+  >     try:
+  >         lines = open(f).readlines()
+  >     except IOError:
+  >         lines = ['line %d\n' % j for j in range(12000)]
+  >     lines[line] = text + '\n'
+  >     open(f, 'w').writelines(lines)
+  > EOF
+  $ python edit.py 3000 base
+  $ hg ci -qAm base -X edit.py
+  $ python edit.py 0 first
+  $ hg ci -qm first
+  $ python edit.py 11999 last
+  $ hg ci -qm last
+  $ hg up -q 1
+  $ python edit.py 6000 middle
+  $ hg amend -q
+  1 new unstable changesets
+  $ hg evolve --all -q --config worker.numcpus=4
+  $ hg log -r tip --template '{rev} {desc}\n'
+  5 last
+  $ hg cat -r tip 'glob:f*' | egrep -c '^(first|middle|last)$'
+  120
+
+Commit hooks run when changesets are relocated without the working directory
+
+  $ cd $TESTTMP
+  $ hg init hooks
+  $ cd hooks
+  $ mkcommit a
+  $ mkcommit b
+  $ hg up -q 0
+  $ echo a2 > a
+  $ hg amend -q
+  1 new unstable changesets
+  $ cat >> .hg/hgrc <<EOF
+  > [hooks]
+  > precommit = echo precommit \$HG_PARENT1
+  > pretxncommit = echo pretxncommit \$HG_NODE \$HG_PARENT1
+  > commit = echo commit \$HG_NODE \$HG_PARENT1
+  > EOF
+  $ hg evolve --config hooks.pretxncommit.fail=false
+  move:[1] add b
+  atop:[3] add a
+  precommit 95de37d1717bf0da2037567a94b5e7a02b86e3de
+  pretxncommit 26d0d0e82051f11d0c8594bcd3a38b2d2acc13b8 95de37d1717bf0da2037567a94b5e7a02b86e3de
+  transaction abort!
+  rollback completed
+  evolve failed!
+  fix conflict and run "hg evolve --continue"
+  abort: pretxncommit.fail hook exited with status 1
+  [255]
+  $ hg log -r 'unstable()' --template '{rev} {desc}\n'
+  1 add b
+  $ hg evolve
+  move:[1] add b
+  atop:[3] add a
+  precommit 95de37d1717bf0da2037567a94b5e7a02b86e3de
+  pretxncommit 26d0d0e82051f11d0c8594bcd3a38b2d2acc13b8 95de37d1717bf0da2037567a94b5e7a02b86e3de
+  commit 26d0d0e82051f11d0c8594bcd3a38b2d2acc13b8 95de37d1717bf0da2037567a94b5e7a02b86e3de
+
+evolve --all keeps the changesets relocated before one failing to commit
+
+  $ cd $TESTTMP
+  $ hg init batchfail
+  $ cd batchfail
+  $ mkcommit a
+  $ mkcommit b
+  $ mkcommit c
+  $ hg up -q 0
+  $ echo a2 > a
+  $ hg amend -q
+  2 new unstable changesets
+  $ hg evolve --all --config hooks.pretxncommit.fail='test "`hg log -r $HG_NODE --template "{desc}"`" != "add c"'
+  move:[1] add b
+  atop:[4] add a
+  move:[2] add c
+  atop:[5] add b
+  transaction abort!
+  rollback completed
+  abort: pretxncommit.fail hook exited with status 1
+  [255]
+  $ hg log -G --template '{rev} {desc}\n'
+  @  5 add b
+  |
+  o  4 add a
+  
+  o  2 add c
+  |
+  x  1 add b
+  |
+  x  0 add a
+  
+  $ hg log -r 'unstable()' --template '{rev} {desc}\n'
+  2 add c
+
+Evolve work can be profiled, the report is written on stderr
+
+  $ cd $TESTTMP
+  $ hg init profile
+  $ cd profile
+  $ mkcommit a
+  $ mkcommit b
+  $ echo b2 > b
+  $ hg amend -q
+  $ hg log -r 'allprecursors(tip)' --hidden --template '{rev}\n' --config evolve.profile=yes 2>&1 >/dev/null | head -2
+  evolve profile for log:
+    revset.allprecursors          1 calls   * seconds (glob)
+
+or appended to a JSON file, one line per command
+
+  $ hg log -r 'allprecursors(tip)' --hidden --template '{rev}\n' --config evolve.profile=yes --config evolve.profile.json=profile.json
+  1
+  $ hg summary --config evolve.profile=yes --config evolve.profile.json=profile.json > /dev/null
+  $ cat > readprofile.py <<EOF
+  > import json
+  > for line in open('profile.json'):
+  >     d = json.loads(line)
+  >     print d['command'], ' '.join('%s:%i' % (name, t['calls'])
+  >                                  for name, t in sorted(d['timers'].items()))
+  > EOF
+  $ python readprofile.py
+  log revset.allprecursors:1
+  summary summaryhook:1
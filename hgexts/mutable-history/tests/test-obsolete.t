@@ -129,6 +129,10 @@ test obsolete changeset with no-obsolete descendant
   summary:     add obsol_c
   
   working directory parent is obsolete!
+(and by aliases of wrapped commands)
+  $ hg pa -q --config alias.pa=parents
+  3:0d3f46688ccc
+  working directory parent is obsolete!
   $ mkcommit d # 5 (on 3)
   1 new unstable changesets
   $ qlog -r 'obsolete()'
@@ -687,3 +691,290 @@ Check import reports new unstable changeset:
   $ hg export 9468a5f5d8b2 | hg import -
   applying patch from stdin
   1 new unstable changesets
+
+Known markers are not added again:
+
+  $ hg debugobsolete aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb -d '0 0'
+  $ hg debugobsolete aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb -d '0 0'
+  $ hg debugobsolete aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa cccccccccccccccccccccccccccccccccccccccc -d '0 0'
+  $ hg debugobsolete | grep aaaaaaaaaaaa
+  aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb 0 {'date': '0 0', 'user': 'test'}
+  aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa cccccccccccccccccccccccccccccccccccccccc 0 {'date': '0 0', 'user': 'test'}
+
+Markers are read back as written, whatever their successors, flags and
+metadata
+
+  $ hg debugobsolete --flags 1 cccccccccccccccccccccccccccccccccccccccc dddddddddddddddddddddddddddddddddddddddd eeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee -d '1 -3600' -u 'Babar <babar@example.com>'
+  $ hg debugobsolete --flags 2 ffffffffffffffffffffffffffffffffffffffff -d '0 0'
+  $ hg debugobsolete | tail -2
+  cccccccccccccccccccccccccccccccccccccccc dddddddddddddddddddddddddddddddddddddddd eeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee 1 {'date': '1 -3600', 'user': 'Babar <babar@example.com>'}
+  ffffffffffffffffffffffffffffffffffffffff 2 {'date': '0 0', 'user': 'test'}
+
+The obsolescence index is kept on disk
+
+  $ cd $TESTTMP
+  $ hg init obsindex
+  $ cd obsindex
+  $ mkcommit a
+  $ mkcommit b
+  $ echo b2 > b
+  $ hg amend -q -d '0 0'
+  $ echo b3 > b
+  $ hg amend -q -d '0 0'
+  $ hg log -r 'allprecursors(.)' --hidden --template '{rev}:{node|short} {desc|firstline}\n'
+  1:7c3bad9141dc add b
+  3:* add b (glob)
+  $ hg log -r 'allsuccessors(1)' --hidden --template '{rev}:{node|short} {desc|firstline}\n'
+  3:* add b (glob)
+  5:* add b (glob)
+  $ ls .hg/cache | grep evolve-obsindex
+  evolve-obsindex
+
+It survives history being stripped, walking through unknown nodes
+
+  $ hg --config extensions.hgext.mq= strip --hidden -q 3
+  $ hg log -G --hidden --template '{rev}:{node|short} {desc|firstline}\n'
+  @  3:7299fe54cbdd add b
+  |
+  | x  2:f2e03851cf90 temporary amend commit for 7c3bad9141dc
+  | |
+  | x  1:7c3bad9141dc add b
+  |/
+  o  0:1f0dee641bb7 add a
+  
+  $ hg log -r 'allprecursors(tip)' --hidden --template '{rev}:{node|short} {desc|firstline}\n'
+  1:7c3bad9141dc add b
+  $ hg log -r 'successors(1)' --hidden --template '{rev}:{node|short} {desc|firstline}\n'
+
+And being corrupted
+
+  $ echo babar > .hg/cache/evolve-obsindex
+  $ hg log -r 'allsuccessors(1)' --hidden --template '{rev}:{node|short} {desc|firstline}\n'
+  3:7299fe54cbdd add b
+
+Trouble warnings and summary do not load the obsolescence index
+
+  $ cd $TESTTMP
+  $ hg init troubledkey
+  $ cd troubledkey
+  $ mkcommit a
+  $ mkcommit b
+  $ hg debugobsolete `getid 0`
+  $ mkcommit c
+  1 new unstable changesets
+  $ hg summary | grep unstable
+  unstable: 2 changesets
+  $ ls .hg/cache | grep evolve
+  evolve-obsrepair
+  evolve-troubled
+
+The cache is rebuilt when corrupted
+
+  $ echo babar > .hg/cache/evolve-troubled
+  $ hg summary | grep unstable
+  unstable: 2 changesets
+
+New markers and moved phases are taken into account
+
+  $ hg phase --public 'desc("add c")'
+  $ hg summary | grep unstable
+  [1]
+  $ hg log -r 'obsolete() + unstable()' --template '{rev} {desc}\n'
+  $ hg phase --draft --force 'desc("add a")'
+  2 new unstable changesets
+  $ hg summary | grep unstable
+  unstable: 2 changesets
+  $ hg prune -q 'desc("add c")'
+  $ hg summary | grep unstable
+  unstable: 1 changesets
+  $ hg log -r 'unstable()' --template '{rev} {desc}\n'
+  1 add b
+
+Obsolescence sets kept between commands of a command server follow changes
+
+  $ cat > $TESTTMP/cmdclient.py <<EOF
+  > import struct, subprocess, sys
+  > def readchannel(server):
+  >     ch, length = struct.unpack('>cI', server.stdout.read(5))
+  >     return ch, server.stdout.read(length)
+  > server = subprocess.Popen(['hg', 'serve', '--cmdserver', 'pipe'],
+  >                           stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+  > readchannel(server)
+  > for line in sys.stdin:
+  >     sys.stdout.write('*** %s' % line)
+  >     if line.startswith('!'):
+  >         subprocess.call(line[1:], shell=True)
+  >         continue
+  >     data = '\0'.join(line.split())
+  >     server.stdin.write('runcommand\n')
+  >     server.stdin.write(struct.pack('>I', len(data)) + data)
+  >     server.stdin.flush()
+  >     ch, data = readchannel(server)
+  >     while ch != 'r':
+  >         sys.stdout.write(data)
+  >         ch, data = readchannel(server)
+  > server.stdin.close()
+  > server.wait()
+  > EOF
+  $ cd $TESTTMP
+  $ hg init cmdserver
+  $ cd cmdserver
+  $ mkcommit a
+  $ mkcommit b
+  $ mkcommit c
+  $ python $TESTTMP/cmdclient.py <<EOF
+  > log -r obsolete() --template {rev}\n
+  > summary
+  > prune -r 1
+  > log -r obsolete() --template {rev}\n
+  > log -r unstable() --template {rev}\n
+  > summary
+  > !hg phase --public 2
+  > log -r obsolete()+unstable() --template {rev}\n
+  > EOF
+  *** log -r obsolete() --template {rev}\n
+  *** summary
+  parent: 2:4538525df7e2 tip
+   add c
+  branch: default
+  commit: (clean)
+  update: (current)
+  *** prune -r 1
+  1 changesets pruned
+  1 new unstable changesets
+  *** log -r obsolete() --template {rev}\n
+  1
+  *** log -r unstable() --template {rev}\n
+  2
+  *** summary
+  parent: 2:4538525df7e2 tip
+   add c
+  branch: default
+  commit: (clean)
+  update: (current)
+  unstable: 1 changesets
+  *** !hg phase --public 2
+  *** log -r obsolete()+unstable() --template {rev}\n
+
+Transitive successors and precursors follow markers added while a command
+server runs, by itself or by another process
+
+  $ cd $TESTTMP
+  $ hg init closures
+  $ cd closures
+  $ mkcommit a
+  $ mkcommit b
+  $ mkcommit c
+  $ python $TESTTMP/cmdclient.py <<EOF
+  > log -r allsuccessors(0) --hidden --template {rev}\n
+  > !hg debugobsolete `hg id --debug -ir 0` `hg id --debug -ir 1`
+  > log -r allsuccessors(0) --hidden --template {rev}\n
+  > log -r allprecursors(2) --hidden --template {rev}\n
+  > debugobsolete 7c3bad9141dcb46ff89abf5f61856facd56e476c 4538525df7e2b9f09423636c61ef63a4cb872a2d
+  > log -r allsuccessors(0) --hidden --template {rev}\n
+  > log -r allprecursors(2) --hidden --template {rev}\n
+  > EOF
+  *** log -r allsuccessors(0) --hidden --template {rev}\n
+  *** !hg debugobsolete 1f0dee641bb7258c56bd60e93edfa2405381c41e 7c3bad9141dcb46ff89abf5f61856facd56e476c
+  *** log -r allsuccessors(0) --hidden --template {rev}\n
+  1
+  *** log -r allprecursors(2) --hidden --template {rev}\n
+  *** debugobsolete 7c3bad9141dcb46ff89abf5f61856facd56e476c 4538525df7e2b9f09423636c61ef63a4cb872a2d
+  *** log -r allsuccessors(0) --hidden --template {rev}\n
+  1
+  2
+  *** log -r allprecursors(2) --hidden --template {rev}\n
+  0
+  1
+
+Extension setup is recorded. Commands run again by a command server install
+nothing twice, wrappers of a core command are installed when it is first run
+
+  $ hg debugevolvesetup
+  attributes: 0
+  commandwrappers: 4
+  extcommandwrappers: 0
+  functionwrappers: 5
+  repos: 1
+  revsets: 6
+  templatekws: 1
+  $ python $TESTTMP/cmdclient.py <<EOF
+  > debugevolvesetup
+  > parents -q
+  > parents -q
+  > debugevolvesetup
+  > EOF
+  *** debugevolvesetup
+  attributes: 0
+  commandwrappers: 4
+  extcommandwrappers: 0
+  functionwrappers: 5
+  repos: 1
+  revsets: 6
+  templatekws: 1
+  *** parents -q
+  2:4538525df7e2
+  *** parents -q
+  2:4538525df7e2
+  *** debugevolvesetup
+  attributes: 0
+  commandwrappers: 5
+  extcommandwrappers: 0
+  functionwrappers: 5
+  repos: 1
+  revsets: 6
+  templatekws: 1
+
+Compacting the obsstore drops markers unrelated to local changesets and
+markers repeating a previous one
+
+  $ cd $TESTTMP
+  $ hg init compact
+  $ cd compact
+  $ mkcommit a
+  $ mkcommit b
+  $ echo b2 > b
+  $ hg amend -q
+  $ hg debugobsolete aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb -d '0 0'
+  $ hg debugobsolete `getid 1` `getid 3` -d '0 0'
+  $ hg debugobsolete
+  7c3bad9141dcb46ff89abf5f61856facd56e476c 176f70ab8e97183c48de06aaeff8eaeb9d7987e1 0 {'date': '* *', 'user': 'test'} (glob)
+  f2e03851cf90b4286a8243c7dc42b488e4dd0f91 0 {'date': '* *', 'user': 'test'} (glob)
+  aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb 0 {'date': '0 0', 'user': 'test'}
+  7c3bad9141dcb46ff89abf5f61856facd56e476c 176f70ab8e97183c48de06aaeff8eaeb9d7987e1 0 {'date': '0 0', 'user': 'test'}
+  $ hg debugobsstorecompact
+  markers: 4 -> 2
+  size: * -> * bytes (glob)
+  parse time: * -> * seconds (glob)
+  $ ls .hg/cache | grep evolve
+  [1]
+  $ hg debugobsolete
+  7c3bad9141dcb46ff89abf5f61856facd56e476c 176f70ab8e97183c48de06aaeff8eaeb9d7987e1 0 {'date': '* *', 'user': 'test'} (glob)
+  f2e03851cf90b4286a8243c7dc42b488e4dd0f91 0 {'date': '* *', 'user': 'test'} (glob)
+  $ hg log -r 'allsuccessors(1)' --hidden --template '{rev}\n'
+  3
+  $ hg debugobsstorecompact
+  obsstore is already compact
+
+Markers rewriting a precursor again, or rewriting its successor, are kept:
+they record divergence and chains of rewrites
+
+  $ mkcommit c
+  $ hg debugobsolete `getid 1` `getid 4`
+  $ echo c2 > c
+  $ hg amend -q
+  $ hg debugobsolete aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb
+  $ hg debugobsolete | wc -l
+  \s*6 (re)
+  $ hg debugobsstorecompact | head -1
+  markers: 6 -> 5
+  $ hg debugobsolete | grep -c aaaaaaaaaaaa
+  0
+  [1]
+  $ hg log -r 'divergent()' --template '{rev} {desc}\n'
+  3 add b
+  6 add c
+  $ hg log -r 'allsuccessors(1)' --hidden --template '{rev} {desc}\n'
+  3 add b
+  4 add c
+  6 add c
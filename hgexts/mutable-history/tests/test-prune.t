@@ -258,3 +258,78 @@ yoinked from test-mq-strip.t
   abort: unknown revision '2702dd0c91e7'!
   [255]
 
+
+bookmarks of pruned changesets move to their highest non-obsolete ancestor,
+across merges
+
+  $ cd ..
+  $ hg init merges
+  $ cd merges
+  $ hg debugbuilddag '+1:base +2:r *base +1 /r'
+  $ hg bookmark -r 2 right
+  $ hg bookmark -r 4 left
+  $ hg bookmark -r 5 merge
+  $ hg log -G
+  o    5:*[merge] (stable/draft) r5 (glob)
+  |\
+  | o  4:*[left] (stable/draft) r4 (glob)
+  | |
+  | o  3:*[] (stable/draft) r3 (glob)
+  | |
+  o |  2:*[right] (stable/draft) r2 (glob)
+  | |
+  o |  1:*[] (stable/draft) r1 (glob)
+  |/
+  o  0:*[] (stable/draft) r0 (glob)
+  
+  $ hg prune -r 'desc(r2) + desc(r4) + desc(r5)'
+  3 changesets pruned
+  $ hg log -r 'bookmark()' --template '{desc} {bookmarks}\n'
+  r1 right
+  r3 left merge
+
+prune -B stops at ancestors of other bookmarks and skips obsolete changesets
+
+  $ cd ..
+  $ hg init stack
+  $ cd stack
+  $ hg debugbuilddag '+5'
+  $ hg bookmark -r 1 low
+  $ hg bookmark -r 4 top
+  $ hg prune -r 3
+  1 changesets pruned
+  1 new unstable changesets
+  $ hg prune -B top
+  2 changesets pruned
+  bookmark 'top' deleted
+  $ hg log -G
+  o  1:*[low] (stable/draft) r1 (glob)
+  |
+  o  0:*[] (stable/draft) r0 (glob)
+  
+
+a bookmark on the null revision has nothing to prune
+
+  $ hg bookmark -r null nb
+  $ hg prune -B nb
+  bookmark 'nb' deleted
+  abort: nothing to prune
+  [255]
+  $ hg bookmarks
+     low                       1:* (glob)
+
+prune -B stops at heads of named branches
+
+  $ cd ..
+  $ hg init branches
+  $ cd branches
+  $ hg debugbuilddag '+1 @stable +1 @default +2'
+  $ hg bookmark -r 3 B
+  $ hg prune -B B
+  2 changesets pruned
+  bookmark 'B' deleted
+  $ hg log -G --template '{rev}:{branch} {desc}\n'
+  o  1:stable r1
+  |
+  o  0:default r0
+  
@@ -88,13 +88,16 @@ Test stabilizing a descendant predecessors child
   $ hg up 7
   0 files updated, 0 files merged, 1 files removed, 0 files unresolved
   $ hg debugobsolete > successors.old
+
+Without conflict, the working directory is updated once, straight to the new
+changeset
+
   $ hg evolve -v
   move:[3] addc
   atop:[8] addb
   hg rebase -r 7a7552255fb5 -d bede829dd2d3
   resolving manifests
   getting b
-  resolving manifests
   getting c
   c
   $ hg debugobsolete > successors.new
@@ -152,10 +155,7 @@ Test behaviour with --any
   atop:[11] addb
   hg rebase -r 65095d7d0dd5 -d 036cf654e942
   resolving manifests
-  removing c
   getting b
-  resolving manifests
-  getting c
   c
   $ glog
   @  12:e99ecf51c867@default(draft) addc
@@ -169,3 +169,18 @@ Test behaviour with --any
   $ hg evolve --any -v
   no troubled changesets
   [1]
+
+A descendant which is also a precursor of a lower descendant is ranked through
+that descendant: the child of r5, precursor of r1, comes before the child of r2
+
+  $ cd ..
+  $ hg init order
+  $ cd order
+  $ hg debugbuilddag '+8'
+  $ hg debugobsolete `hg log -r 2 --template '{node}'`
+  $ hg debugobsolete `hg log -r 5 --template '{node}'` `hg log -r 1 --template '{node}'`
+  $ hg up -q 0
+  $ hg evolve -n
+  move:[6] r6
+  atop:[1] r1
+  hg rebase -r * -d * (glob)
@@ -86,3 +86,13 @@ Multiple touch
   o  4:[0-9a-f]{12} a (re)
   
 
+
+Touching parents of an uncommitted merge updates both of them
+
+  $ hg merge 4
+  0 files updated, 0 files merged, 0 files removed, 0 files unresolved
+  (branch merge, don't forget to commit)
+  $ hg touch 4 8:9
+  $ hg parents
+  12:[0-9a-f]{12} d (re)
+  10:[0-9a-f]{12} a (re)